@@ -1,16 +1,59 @@
-from flask import Flask, request, jsonify, render_template_string, send_file, redirect, session, url_for, Response, current_app
+from flask import Flask, request, jsonify, render_template, send_file, send_from_directory, redirect, session, url_for, Response, make_response
 from datetime import datetime, timedelta, timezone
 import psycopg2
+import psycopg2.errors
+import click
 import os
 import pytz
 from dateutil import parser
 from urllib.parse import urlparse
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from psycopg2.extensions import (
+    POLL_OK, POLL_READ, POLL_WRITE, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN,
+    set_wait_callback,
+)
+from psycopg2 import sql
+from psycopg2.errors import QueryCanceled
+from psycopg2.pool import PoolError
 import re
-import hashlib
 import json
-
-app = Flask(__name__)
+import functools
+import hashlib
+import math
+import io
+import csv
+import zlib
+import threading
+import queue
+import select
+import atexit
+import time
+import sqlite3
+import tempfile
+
+try:
+    from gevent import get_hub, monkey as gevent_monkey
+    from gevent.socket import wait_read, wait_write
+except ImportError:  # plain `flask run` / sync workers
+    gevent_monkey = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # columnar exports are unavailable
+    pyarrow = None
+
+try:
+    import brotli
+except ImportError:  # JSON responses are only gzipped
+    brotli = None
+from werkzeug.security import safe_join
+
+# /static is served by static_file() below, with cache headers that depend
+# on whether the URL is fingerprinted.
+app = Flask(__name__, static_folder=None)
+STATIC_DIR = os.path.join(app.root_path, "static")
 
 # Config
 EGYPT_TZ = pytz.timezone("Africa/Cairo")
@@ -19,60 +62,974 @@ API_KEY = os.getenv("DASHBOARD_API_KEY")
 RESET_KEY = os.getenv("RESET_KEY")
 USERNAME = os.getenv("LOGIN_USER")
 PASSWORD = os.getenv("LOGIN_PASS")
-_last_data_hash = None
-_last_updated_timestamp = None
-subscribers = []
-
-# PostgreSQL Connection
-def get_db_conn():
-    db_url = os.getenv("DATABASE_URL")
-    if not db_url:
-        raise ValueError("DATABASE_URL not set")
-    result = urlparse(db_url)
-    return psycopg2.connect(
-        dbname=result.path[1:],
-        user=result.username,
-        password=result.password,
-        host=result.hostname,
-        port=result.port
-    )
+
+# PostgreSQL Connection Pool
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))      # seconds to wait for a free connection
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))  # ping connections idle longer than this
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))  # server-side default per statement
+DB_READ_TIMEOUT_MS = int(os.getenv("DB_READ_TIMEOUT_MS", "10000"))  # tighter limit for dashboard queries
+
+
+# psycopg2 blocks in C while waiting on the server. Under the gevent worker we
+# switch it to async mode and wait on the socket cooperatively, so a slow
+# GROUP BY only parks its own greenlet. If the greenlet is interrupted while
+# waiting (gevent.Timeout, worker shutdown, killed greenlet) the statement is
+# cancelled on the server; psycopg2 then marks the connection broken and the
+# pool discards it.
+def gevent_wait_callback(conn, timeout=None):
+    try:
+        while True:
+            state = conn.poll()
+            if state == POLL_OK:
+                break
+            elif state == POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+    except psycopg2.Error:
+        raise
+    except BaseException:
+        if not conn.closed:
+            conn.cancel()
+        raise
+
+def gevent_patched():
+    return gevent_monkey is not None and gevent_monkey.is_module_patched("socket")
+
+@contextmanager
+def blocking_io():
+    # psycopg2 refuses COPY while a wait callback is installed. The COPY then
+    # blocks the whole hub, so no other greenlet can run while the callback
+    # is briefly removed.
+    if not gevent_patched():
+        yield
+        return
+    set_wait_callback(None)
+    try:
+        yield
+    finally:
+        set_wait_callback(gevent_wait_callback)
+
+
+# Bounded pool shared by all requests in a worker. Callers block (up to
+# DB_POOL_TIMEOUT) when it is exhausted; under the gevent worker the pool is
+# built after monkey-patching, so waiting yields to the hub.
+class ConnectionPool:
+    def __init__(self, connect_kwargs, minconn, maxconn, timeout, check_idle):
+        self.connect_kwargs = connect_kwargs
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.pid = os.getpid()
+        self.ready = False  # set once the schema has been ensured
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, returned_at)
+        self._size = 0
+        self._stats = defaultdict(int)
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        self._stats["created"] += 1
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def _healthy(self, conn, idle_for):
+        if conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if idle_for < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._stats["discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                waited = False
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolError(f"no database connection available within {self.timeout}s")
+                    waited = True
+                    self._cond.wait(remaining)
+                if waited:
+                    self._stats["waits"] += 1
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                else:
+                    conn, returned_at = None, None
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(conn, time.monotonic() - returned_at):
+                self._discard(conn)
+                continue
+
+            self._stats["checkouts"] += 1
+            return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._size -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min": self.minconn,
+                "max": self.maxconn,
+                **self._stats,
+            }
+
+
+_pool = None
+_pool_lock = threading.RLock()
+
+def get_pool():
+    global _pool
+    # Created lazily so each gunicorn worker builds its own pool after fork
+    # (and after gevent has patched threading). The schema is ensured once per
+    # worker right after; init_db() gets its connections through here too,
+    # which the reentrant lock allows, while other threads wait until the
+    # pool is ready.
+    pool = _pool
+    if pool is None or pool.pid != os.getpid() or not pool.ready:
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                db_url = os.getenv("DATABASE_URL")
+                if not db_url:
+                    raise ValueError("DATABASE_URL not set")
+                if gevent_patched():
+                    set_wait_callback(gevent_wait_callback)
+                result = urlparse(db_url)
+                _pool = ConnectionPool(
+                    dict(
+                        dbname=result.path[1:],
+                        user=result.username,
+                        password=result.password,
+                        host=result.hostname,
+                        port=result.port,
+                        options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+                    ),
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    check_idle=DB_POOL_CHECK_IDLE,
+                )
+                try:
+                    setup()
+                except Exception:
+                    _pool = None
+                    raise
+                _pool.ready = True
+                threading.Thread(target=maintenance_loop, name="maintenance", daemon=True).start()
+    return _pool
+
+@contextmanager
+def get_db_conn(statement_timeout_ms=None, autocommit=False):
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        # Autocommit skips the implicit BEGIN/COMMIT round trips; only use it
+        # for single-statement work.
+        conn.autocommit = autocommit
+        if statement_timeout_ms is not None:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (statement_timeout_ms,))
+        yield conn
+        # publish_data_change() may have lost the connection after its commit.
+        if not conn.closed:
+            conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        if autocommit and not conn.closed:
+            conn.autocommit = False
+        pool.putconn(conn, discard=broken)
 
 # Init tables
 def init_db():
-    with get_db_conn() as conn:
+    # No statement timeout: backfilling a rollup from a large readings table,
+    # or waiting for another worker doing so, takes as long as it takes, and
+    # a timeout would only make the next request start over.
+    with get_db_conn(statement_timeout_ms=0) as conn:
         with conn.cursor() as cur:
+            # Workers start concurrently; serialize schema changes.
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('rock-dashboard:init_db'))")
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            ''')
+            sync_size_bins(cur)
+            # Raw readings, one row per post: the node as an id into nodes and
+            # the counts as an array indexed by size_bins.id. realdata is a
+            # view with the original one-row-per-size layout for readers.
             cur.execute('''
-                CREATE TABLE IF NOT EXISTS realdata (
+                CREATE TABLE IF NOT EXISTS nodes (
                     id SERIAL PRIMARY KEY,
-                    node TEXT,
+                    name TEXT NOT NULL UNIQUE,
+                    last_seen TIMESTAMPTZ,
                     status TEXT,
-                    timestamp TIMESTAMPTZ,
-                    size_range TEXT,
-                    count INTEGER
+                    version TEXT,
+                    reported_at TIMESTAMPTZ,
+                    post_rate DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    rate_at TIMESTAMPTZ
                 );
             ''')
+            cur.execute("SELECT to_regclass('readings') IS NULL")
+            if cur.fetchone()[0]:
+                cur.execute('''
+                    CREATE TABLE readings (
+                        node_id INTEGER NOT NULL,
+                        timestamp TIMESTAMPTZ NOT NULL,
+                        status TEXT,
+                        counts INTEGER[] NOT NULL
+                    ) PARTITION BY RANGE (timestamp);
+                ''')
+                cur.execute("CREATE INDEX readings_timestamp_brin ON readings USING brin (timestamp)")
+            now = datetime.now(timezone.utc)
+            ensure_partitions(cur, now, partition_ahead(now))
+            # A realdata table from before the readings layout stays readable
+            # through the view as realdata_long until `flask migrate-realdata`
+            # has moved its rows over.
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('realdata')")
+            row = cur.fetchone()
+            if row and row[0] in ("r", "p"):
+                cur.execute("ALTER TABLE realdata RENAME TO realdata_long")
+            create_realdata_view(cur)
+            cur.execute("SELECT to_regclass('realdata_long') IS NOT NULL")
+            if cur.fetchone()[0]:
+                app.logger.warning("realdata_long holds rows in the old layout; run `flask migrate-realdata`")
+            # Newest reading per node, advanced by ingest_rows(); the newest
+            # of them is the dashboards' "last updated". It replaces a single
+            # meta row that every ingest used to rewrite.
+            if not column_exists(cur, "nodes", "last_seen"):
+                cur.execute("ALTER TABLE nodes ADD COLUMN last_seen TIMESTAMPTZ")
+            cur.execute("DELETE FROM meta WHERE key = 'last_update' RETURNING value")
+            if cur.fetchone():
+                cur.execute('''
+                    INSERT INTO nodes (name, last_seen)
+                    SELECT node, MAX(timestamp) FROM realdata WHERE node IS NOT NULL GROUP BY node
+                    ON CONFLICT (name) DO UPDATE SET last_seen = EXCLUDED.last_seen
+                ''')
+            # What each node last reported, written by the node registry.
+            if not column_exists(cur, "nodes", "post_rate"):
+                cur.execute('''
+                    ALTER TABLE nodes
+                        ADD COLUMN status TEXT,
+                        ADD COLUMN version TEXT,
+                        ADD COLUMN reported_at TIMESTAMPTZ,
+                        ADD COLUMN post_rate DOUBLE PRECISION NOT NULL DEFAULT 0,
+                        ADD COLUMN rate_at TIMESTAMPTZ
+                ''')
+            # Running totals per node and size bucket, maintained by
+            # ingest_rows() in the same transaction as the raw rows.
+            # changed_xid is the last transaction that touched the cell and
+            # drives the /dashboard-data?since= delta sync.
+            cur.execute("SELECT to_regclass('node_totals') IS NULL")
+            totals_missing = cur.fetchone()[0]
             cur.execute('''
-                CREATE TABLE IF NOT EXISTS meta (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
+                CREATE TABLE IF NOT EXISTS node_totals (
+                    node TEXT NOT NULL,
+                    size_range TEXT NOT NULL,
+                    total BIGINT NOT NULL,
+                    changed_xid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+                    PRIMARY KEY (node, size_range)
+                );
+            ''')
+            if not column_exists(cur, "node_totals", "changed_xid"):
+                cur.execute("ALTER TABLE node_totals ADD COLUMN "
+                            "changed_xid XID8 NOT NULL DEFAULT pg_current_xact_id()")
+            # Per-minute sums behind /api/daily-trend, also maintained on ingest.
+            cur.execute("SELECT to_regclass('realdata_minute') IS NULL")
+            minute_missing = cur.fetchone()[0]
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS realdata_minute (
+                    minute TIMESTAMPTZ NOT NULL,
+                    node TEXT NOT NULL,
+                    size_range TEXT NOT NULL,
+                    total BIGINT NOT NULL,
+                    PRIMARY KEY (minute, node, size_range)
+                );
+            ''')
+            # Per Cairo-local-day sums behind /api/history.
+            cur.execute("SELECT to_regclass('realdata_daily') IS NULL")
+            daily_missing = cur.fetchone()[0]
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS realdata_daily (
+                    day DATE NOT NULL,
+                    node TEXT NOT NULL,
+                    size_range TEXT NOT NULL,
+                    total BIGINT NOT NULL,
+                    PRIMARY KEY (day, node, size_range)
                 );
             ''')
+            # Backfill derived tables created just now. node_totals goes last
+            # since, once raw rows have expired, it is rebuilt from the daily
+            # rollup.
+            if daily_missing:
+                rebuild_daily_rollup(cur)
+            if minute_missing:
+                rebuild_minute_rollup(cur)
+            if totals_missing:
+                rebuild_node_totals(cur)
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS data_version_seq")
             conn.commit()
+        # Covers changes committed by a worker that died before bumping.
+        publish_data_change(conn)
+
+# ALTER TABLE takes an exclusive lock even when there is nothing to do, which
+# would stall (or deadlock with) ingests in workers that are already up.
+def column_exists(cur, table, column):
+    cur.execute("SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = %s AND NOT attisdropped",
+                (table, column))
+    return cur.fetchone() is not None
+
+# Copies SIZE_BINS into size_bins. A bin keeps its id for good, since it
+# indexes readings.counts; bins dropped from the configuration stay in the
+# table, without a position, so old readings still decode.
+def sync_size_bins(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS size_bins (
+            id SMALLINT NOT NULL UNIQUE,
+            label TEXT PRIMARY KEY,
+            position INTEGER,
+            min_mm NUMERIC,
+            max_mm NUMERIC,
+            size_class TEXT NOT NULL,
+            color TEXT NOT NULL
+        );
+    ''')
+    # size_bins tables from before readings existed have no ids yet.
+    add_ids = not column_exists(cur, "size_bins", "id")
+    if add_ids:
+        cur.execute("ALTER TABLE size_bins ADD COLUMN id SMALLINT UNIQUE")
+        cur.execute("ALTER TABLE size_bins ALTER COLUMN position DROP NOT NULL")
+    cur.execute("SELECT label, id FROM size_bins WHERE id IS NOT NULL")
+    ids = dict(cur.fetchall())
+    next_id = max(ids.values(), default=0) + 1
+    cur.execute("UPDATE size_bins SET position = NULL")
+    for position, b in enumerate(SIZE_BINS):
+        if b["label"] not in ids:
+            ids[b["label"]] = next_id
+            next_id += 1
+        cur.execute("""
+            INSERT INTO size_bins (id, label, position, min_mm, max_mm, size_class, color)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (label) DO UPDATE SET id = EXCLUDED.id, position = EXCLUDED.position, min_mm = EXCLUDED.min_mm,
+                max_mm = EXCLUDED.max_mm, size_class = EXCLUDED.size_class, color = EXCLUDED.color
+        """, (ids[b["label"]], b["label"], position, b["min_mm"], b["max_mm"], b["class"], b["color"]))
+    if add_ids:
+        cur.execute("DELETE FROM size_bins WHERE id IS NULL")
+        cur.execute("ALTER TABLE size_bins ALTER COLUMN id SET NOT NULL")
+    SIZE_BIN_IDS.clear()
+    SIZE_BIN_IDS.update(ids)
+
+# The view is only replaced when its definition has changed, tracked by a
+# hash in its comment: CREATE OR REPLACE VIEW locks it exclusively, which
+# would queue behind any open reader (an /export, say) and every query on
+# realdata behind that. If the lock is not granted within
+# MAINTENANCE_LOCK_TIMEOUT_MS the old definition stays until the next start.
+def create_realdata_view(cur):
+    cur.execute("SELECT to_regclass('realdata_long') IS NOT NULL")
+    legacy = cur.fetchone()[0]
+    # Rows from before the last /reset are archived: hidden here and dropped
+    # later by the maintenance job. The cutoff is a one-row initplan, so
+    # partitions entirely before it are pruned when the query starts. Sizes a
+    # post did not report are NULL in counts and have no row.
+    visible = sql.SQL("timestamp >= (SELECT COALESCE(MAX(value::timestamptz), '-infinity') FROM meta WHERE key = 'reset_at')")
+    definition = sql.SQL('''
+        CREATE OR REPLACE VIEW realdata AS
+        SELECT n.name AS node, r.status, r.timestamp, b.label AS size_range, c.count
+        FROM readings r
+        JOIN nodes n ON n.id = r.node_id
+        CROSS JOIN LATERAL unnest(r.counts) WITH ORDINALITY AS c(count, bin_id)
+        JOIN size_bins b ON b.id = c.bin_id
+        WHERE r.{visible} AND c.count IS NOT NULL
+        {legacy}
+    ''').format(visible=visible,
+                legacy=sql.SQL("UNION ALL SELECT node, status, timestamp, size_range, count FROM realdata_long WHERE {}")
+                .format(visible) if legacy else sql.SQL("")).as_string(cur)
+    digest = hashlib.sha256(definition.encode()).hexdigest()[:16]
+    cur.execute("SELECT obj_description(to_regclass('realdata'), 'pg_class')")
+    if cur.fetchone()[0] == digest:
+        return
+    cur.execute("SAVEPOINT realdata_view")
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s", (MAINTENANCE_LOCK_TIMEOUT_MS,))
+        cur.execute(definition)
+        cur.execute(sql.SQL("COMMENT ON VIEW realdata IS {}").format(sql.Literal(digest)))
+        cur.execute("SET LOCAL lock_timeout = DEFAULT")
+        cur.execute("RELEASE SAVEPOINT realdata_view")
+    except psycopg2.errors.LockNotAvailable:
+        cur.execute("ROLLBACK TO SAVEPOINT realdata_view")
+        app.logger.warning("realdata is busy; its definition is updated on the next start")
+
+# Partitions of readings, one per PARTITION_INTERVAL ("month" or "week") in
+# UTC, named after their lower bound. PARTITIONS_AHEAD future partitions are
+# kept ready by init_db() and the maintenance job; backlog uploads create
+# older ones on demand.
+PARTITION_INTERVAL = os.getenv("PARTITION_INTERVAL", "month")
+PARTITIONS_AHEAD = int(os.getenv("PARTITIONS_AHEAD", "2"))
+
+def partition_bounds(ts):
+    ts = ts.astimezone(timezone.utc)
+    if PARTITION_INTERVAL == "week":
+        lower = (ts - timedelta(days=ts.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        return lower, lower + timedelta(days=7)
+    lower = ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return lower, (lower + timedelta(days=32)).replace(day=1)
+
+def partition_ahead(ts):
+    upper = partition_bounds(ts)[1]
+    for _ in range(PARTITIONS_AHEAD):
+        upper = partition_bounds(upper)[1]
+    return upper - timedelta(microseconds=1)
+
+def ensure_partitions(cur, start, end):
+    # Creating a partition locks readings exclusively until commit, so callers
+    # run this in its own short transaction, never inside a bulk load.
+    lower, upper = partition_bounds(start)
+    while lower <= end:
+        name = f"readings_p{lower:%Y%m%d}"
+        cur.execute("SELECT to_regclass(%s) IS NULL", (name,))
+        if cur.fetchone()[0]:
+            cur.execute("SAVEPOINT ensure_partition")
+            try:
+                cur.execute(
+                    sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF readings FOR VALUES FROM (%s) TO (%s)")
+                    .format(sql.Identifier(name)),
+                    (lower, upper)
+                )
+                cur.execute("RELEASE SAVEPOINT ensure_partition")
+            except psycopg2.errors.InvalidObjectDefinition:
+                # Already covered by another partition with a different interval.
+                cur.execute("ROLLBACK TO SAVEPOINT ensure_partition")
+        lower, upper = partition_bounds(upper)
+
+# Retention can drop old raw rows (see apply_retention); the rollups keep
+# their counts. The raw horizon in meta marks where complete raw data starts,
+# so rebuilds only recompute what realdata still covers. Daily rows are
+# rebuilt from the Cairo day after the horizon, as the horizon's own day is
+# only partly covered by raw rows.
+def raw_horizon(cur):
+    cur.execute("SELECT value FROM meta WHERE key = 'raw_horizon'")
+    row = cur.fetchone()
+    if not row:
+        return None, None, None
+    horizon = parser.isoparse(row[0])
+    horizon_day = horizon.astimezone(EGYPT_TZ).date()
+    raw_from = EGYPT_TZ.localize(datetime.combine(horizon_day + timedelta(days=1), datetime.min.time()))
+    return horizon, horizon_day, raw_from
+
+# /reset does not delete history; it records reset_at, and everything
+# before it is archived (see create_realdata_view and retention_plan).
+def reset_cutoff(cur):
+    cur.execute("SELECT value::timestamptz FROM meta WHERE key = 'reset_at'")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+# Where a table's visible data starts after the reset at reset_at: raw rows
+# at the reset itself, the rollups at the start of the minute or Cairo day it
+# fell in, since /reset cleared those buckets.
+def reset_floor(table, reset_at):
+    if reset_at is None:
+        return None
+    if table == "realdata_minute":
+        return reset_at.astimezone(timezone.utc).replace(second=0, microsecond=0)
+    if table == "realdata_daily":
+        return EGYPT_TZ.localize(datetime.combine(reset_at.astimezone(EGYPT_TZ).date(), datetime.min.time()))
+    return reset_at
+
+def node_totals_source(cur):
+    _, horizon_day, raw_from = raw_horizon(cur)
+    daily_from = reset_floor("realdata_daily", reset_cutoff(cur))
+    return cur.mogrify('''
+        SELECT node, size_range, SUM(total)::bigint AS total
+        FROM (
+            SELECT node, size_range, total FROM realdata_daily WHERE day <= %s AND day >= %s
+            UNION ALL
+            SELECT node, size_range, count FROM realdata
+            WHERE timestamp >= %s AND node IS NOT NULL AND size_range IS NOT NULL AND count IS NOT NULL
+        ) sources
+        GROUP BY node, size_range
+    ''', (horizon_day, daily_from.date() if daily_from else "-infinity", raw_from or "-infinity"))
+
+def rebuild_node_totals(cur):
+    # Blocks concurrent ingests from touching the totals until we commit, so
+    # every committed realdata row is counted exactly once.
+    source = node_totals_source(cur)
+    cur.execute("LOCK TABLE node_totals IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute("DELETE FROM node_totals")
+    cur.execute(b"INSERT INTO node_totals (node, size_range, total) " + source)
+    mark_totals_reset(cur)
+
+# Records that node_totals cells may have been deleted, so delta clients
+# holding an older version must refetch everything.
+def mark_totals_reset(cur):
+    cur.execute("""
+        INSERT INTO meta (key, value) VALUES ('totals_reset_xid', pg_current_xact_id()::text)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+    """)
+
+def rebuild_minute_rollup(cur):
+    horizon, _, _ = raw_horizon(cur)
+    since = horizon or "-infinity"
+    cur.execute("LOCK TABLE realdata_minute IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute("DELETE FROM realdata_minute WHERE minute >= %s", (since,))
+    cur.execute('''
+        INSERT INTO realdata_minute (minute, node, size_range, total)
+        SELECT DATE_TRUNC('minute', timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', node, size_range, SUM(count)
+        FROM realdata
+        WHERE timestamp >= %s AND node IS NOT NULL AND size_range IS NOT NULL AND count IS NOT NULL
+        GROUP BY 1, node, size_range
+    ''', (since,))
+
+def rebuild_daily_rollup(cur):
+    _, horizon_day, raw_from = raw_horizon(cur)
+    cur.execute("LOCK TABLE realdata_daily IN SHARE ROW EXCLUSIVE MODE")
+    if horizon_day is None:
+        cur.execute("DELETE FROM realdata_daily")
+    else:
+        cur.execute("DELETE FROM realdata_daily WHERE day > %s", (horizon_day,))
+    cur.execute('''
+        INSERT INTO realdata_daily (day, node, size_range, total)
+        SELECT (timestamp AT TIME ZONE 'Africa/Cairo')::date, node, size_range, SUM(count)
+        FROM realdata
+        WHERE timestamp >= %s AND node IS NOT NULL AND size_range IS NOT NULL AND count IS NOT NULL
+        GROUP BY 1, node, size_range
+    ''', (raw_from or "-infinity",))
+
+# Retention: raw rows are kept RAW_RETENTION_DAYS, minute rollups
+# MINUTE_RETENTION_DAYS, daily rollups forever (0 keeps a tier forever).
+# Every ingest already adds its counts to the rollups in the same transaction,
+# so expiring a tier never loses data from the coarser ones. Whole readings
+# partitions are detached and dropped instead of deleting rows. Data archived
+# by /reset is expired here as well, whatever the retention settings.
+RAW_RETENTION_DAYS = int(os.getenv("RAW_RETENTION_DAYS", "0"))
+MINUTE_RETENTION_DAYS = int(os.getenv("MINUTE_RETENTION_DAYS", "0"))
+
+def retention_cutoff(now, days):
+    return (now - timedelta(days=days)).astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+# Partition row counts come from the planner statistics unless `exact` is
+# set, as counting every partition each maintenance round would be costly.
+def retention_plan(cur, now, exact=False):
+    plan = []
+    reset_at = reset_cutoff(cur)
+    cutoff = max(filter(None, [RAW_RETENTION_DAYS and retention_cutoff(now, RAW_RETENTION_DAYS), reset_at]),
+                 default=None)
+    if cutoff is not None:
+        cur.execute('''
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), pg_total_relation_size(c.oid), c.reltuples,
+                   i.inhdetachpending
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'readings'::regclass
+            ORDER BY 1
+        ''')
+        for name, bound, size, rows, pending in cur.fetchall():
+            bounds = re.search(r"FROM \('([^']+)'\) TO \('([^']+)'\)", bound)
+            if bounds and parser.parse(bounds.group(2)) <= cutoff:
+                # reltuples is -1 until the partition has been analyzed.
+                count = exact or rows < 0
+                if count:
+                    cur.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(name)))
+                    rows = cur.fetchone()[0]
+                plan.append({"action": "drop_partition", "table": name, "from": parser.parse(bounds.group(1)),
+                             "until": parser.parse(bounds.group(2)), "rows": int(rows), "exact": count,
+                             "bytes": size, "detach": "FINALIZE" if pending else "CONCURRENTLY"})
+        # Partitions detached by an earlier run that could not drop them.
+        cur.execute('''
+            SELECT c.relname, pg_total_relation_size(c.oid) FROM pg_class c
+            WHERE c.relkind = 'r' AND c.relname LIKE 'readings\\_p%' AND NOT c.relispartition
+            ORDER BY 1
+        ''')
+        for name, size in cur.fetchall():
+            lower = datetime.strptime(name, "readings_p%Y%m%d").replace(tzinfo=timezone.utc)
+            cur.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(name)))
+            plan.append({"action": "drop_partition", "table": name, "from": lower,
+                         "until": partition_bounds(lower)[1], "rows": cur.fetchone()[0], "exact": True,
+                         "bytes": size, "detach": None})
+        # Rows not yet migrated out of the old layout are deleted instead.
+        cur.execute("SELECT to_regclass('realdata_long') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT COUNT(*) FROM realdata_long WHERE timestamp < %s", (cutoff,))
+            rows = cur.fetchone()[0]
+            if rows:
+                plan.append({"action": "delete_rows", "table": "realdata_long", "until": cutoff,
+                             "rows": rows, "exact": True, "bytes": estimated_bytes(cur, "realdata_long", rows)})
+    cutoff = max(filter(None, [MINUTE_RETENTION_DAYS and retention_cutoff(now, MINUTE_RETENTION_DAYS),
+                               reset_floor("realdata_minute", reset_at)]), default=None)
+    if cutoff is not None:
+        cur.execute("SELECT COUNT(*) FROM realdata_minute WHERE minute < %s", (cutoff,))
+        rows = cur.fetchone()[0]
+        if rows:
+            plan.append({"action": "delete_rows", "table": "realdata_minute", "until": cutoff,
+                         "rows": rows, "exact": True, "bytes": estimated_bytes(cur, "realdata_minute", rows)})
+    if reset_at is not None:
+        day = reset_floor("realdata_daily", reset_at).date()
+        cur.execute("SELECT COUNT(*) FROM realdata_daily WHERE day < %s", (day,))
+        rows = cur.fetchone()[0]
+        if rows:
+            plan.append({"action": "delete_rows", "table": "realdata_daily", "until": day,
+                         "rows": rows, "exact": True, "bytes": estimated_bytes(cur, "realdata_daily", rows)})
+    return plan
+
+def estimated_bytes(cur, table, rows):
+    # Share of the table (heap + indexes) taken by `rows` rows. Deleted rows
+    # are reused by later inserts rather than returned to the OS.
+    cur.execute("SELECT pg_total_relation_size(%s::regclass), GREATEST(reltuples, 1) FROM pg_class WHERE oid = %s::regclass",
+                (table, table))
+    size, total_rows = cur.fetchone()
+    return int(size * min(rows / total_rows, 1))
+
+# Each step commits on its own under MAINTENANCE_LOCK_TIMEOUT_MS, so
+# maintenance never queues an exclusive lock behind a long reader (an open
+# /export, say) and holds up ingests behind it. A step that cannot get its
+# locks in time is skipped and retried on the next run. Partitions are
+# detached CONCURRENTLY, which does not block inserts into readings; a detach
+# interrupted half-way is finalized on the next run. Returns the steps done.
+MAINTENANCE_LOCK_TIMEOUT_MS = int(os.getenv("MAINTENANCE_LOCK_TIMEOUT_MS", "2000"))
+RETENTION_TIME_COLUMNS = {"realdata_long": "timestamp", "realdata_minute": "minute", "realdata_daily": "day"}
+
+def apply_retention(conn, plan):
+    applied = []
+    for step in plan:
+        try:
+            if step["action"] == "drop_partition":
+                name = sql.Identifier(step["table"])
+                if step["detach"]:
+                    conn.autocommit = True  # DETACH ... CONCURRENTLY cannot run in a transaction
+                    try:
+                        with conn.cursor() as cur:
+                            cur.execute("SET lock_timeout = %s", (MAINTENANCE_LOCK_TIMEOUT_MS,))
+                            try:
+                                cur.execute(sql.SQL("ALTER TABLE readings DETACH PARTITION {} {}")
+                                            .format(name, sql.SQL(step["detach"])))
+                            finally:
+                                cur.execute("RESET lock_timeout")
+                    finally:
+                        conn.autocommit = False
+                with conn.cursor() as cur:
+                    cur.execute("SET LOCAL lock_timeout = %s", (MAINTENANCE_LOCK_TIMEOUT_MS,))
+                    cur.execute(sql.SQL("DROP TABLE {}").format(name))
+                    set_raw_horizon(cur, step["until"])
+            else:
+                with conn.cursor() as cur:
+                    cur.execute("SET LOCAL lock_timeout = %s", (MAINTENANCE_LOCK_TIMEOUT_MS,))
+                    table = step["table"]
+                    cur.execute(sql.SQL("DELETE FROM {} WHERE {} < %s")
+                                .format(sql.Identifier(table), sql.Identifier(RETENTION_TIME_COLUMNS[table])),
+                                (step["until"],))
+                    if step["table"] == "realdata_long":
+                        set_raw_horizon(cur, step["until"])
+            conn.commit()
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            app.logger.warning("Retention: %s is busy, skipped until the next run", step["table"])
+            continue
+        applied.append(step)
+    return applied
+
+# Marks where complete raw data starts (see raw_horizon); it only moves
+# forward.
+def set_raw_horizon(cur, horizon):
+    cur.execute("""
+        INSERT INTO meta (key, value) VALUES ('raw_horizon', %s)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        WHERE meta.value::timestamptz < EXCLUDED.value::timestamptz
+    """, (horizon.isoformat(),))
+
+def describe_retention(plan):
+    if not plan:
+        return ["Nothing to expire."]
+    lines = []
+    for step in plan:
+        rows = f"{step['rows']} rows" if step["exact"] else f"~{step['rows']} rows (estimated)"
+        if step["action"] == "drop_partition":
+            target = (f"drop partition {step['table']} [{step['from'].isoformat()}, {step['until'].isoformat()})"
+                      + {"FINALIZE": " (detach pending)", None: " (already detached)"}.get(step["detach"], ""))
+        else:
+            column = RETENTION_TIME_COLUMNS[step["table"]]
+            target = f"delete from {step['table']} where {column} < {step['until'].isoformat()}"
+        lines.append(f"{target}: {rows}, ~{step['bytes'] / 1024 / 1024:.1f} MiB")
+    total = sum(step["bytes"] for step in plan)
+    lines.append(f"Total reclaimable: ~{total / 1024 / 1024:.1f} MiB")
+    return lines
 
 def setup():
     init_db()
 
-# Login HTML (you can replace this with your full template later)
-@app.route('/', methods=['GET', 'POST'])
-def login():
-    html = """
+# Periodic housekeeping, run by one background thread per worker; the
+# advisory lock makes sure only one worker does the work each round.
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+
+def run_maintenance():
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            # A session lock, as the steps below commit one by one.
+            cur.execute("SELECT pg_try_advisory_lock(hashtext('rock-dashboard:maintenance'))")
+            locked = cur.fetchone()[0]
+            conn.commit()
+            if not locked:
+                return
+            try:
+                now = datetime.now(timezone.utc)
+                try:
+                    cur.execute("SET LOCAL lock_timeout = %s", (MAINTENANCE_LOCK_TIMEOUT_MS,))
+                    ensure_partitions(cur, now, partition_ahead(now))
+                    conn.commit()
+                except psycopg2.errors.LockNotAvailable:
+                    conn.rollback()
+                    app.logger.warning("Maintenance: readings is busy, partitions not created until the next run")
+                plan = retention_plan(cur, now)
+                conn.commit()
+                if plan:
+                    for line in describe_retention(apply_retention(conn, plan)):
+                        app.logger.info("Retention: %s", line)
+            finally:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(hashtext('rock-dashboard:maintenance'))")
+                conn.commit()
+
+def maintenance_loop():
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        try:
+            run_maintenance()
+        except Exception:
+            app.logger.exception("Maintenance run failed")
+
+# CLI commands scan or rewrite whole tables, which is what they are run for,
+# so their process's pool is created without DB_STATEMENT_TIMEOUT_MS.
+def without_statement_timeout(command):
+    @functools.wraps(command)
+    def wrapper(*args, **kwargs):
+        global DB_STATEMENT_TIMEOUT_MS
+        DB_STATEMENT_TIMEOUT_MS = 0
+        return command(*args, **kwargs)
+    return wrapper
+
+@app.cli.command("check-totals")
+@click.option("--repair", is_flag=True, help="Rebuild node_totals from realdata if they differ.")
+@without_statement_timeout
+def check_totals(repair):
+    """Compare node_totals with a full aggregation of realdata."""
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(b"""
+                SELECT COALESCE(r.node, t.node), COALESCE(r.size_range, t.size_range), r.total, t.total
+                FROM (""" + node_totals_source(cur) + b""") r
+                FULL JOIN node_totals t ON t.node = r.node AND t.size_range = r.size_range
+                WHERE COALESCE(r.total, 0) <> COALESCE(t.total, 0)
+                ORDER BY 1, 2
+            """)
+            mismatches = cur.fetchall()
+            for node, size_range, expected, stored in mismatches:
+                click.echo(f"{node} {size_range}: realdata={expected or 0} node_totals={stored or 0}")
+            if not mismatches:
+                click.echo("node_totals is consistent with realdata.")
+            elif repair:
+                rebuild_node_totals(cur)
+                conn.commit()
+                publish_data_change(conn)
+                click.echo(f"Rebuilt node_totals ({len(mismatches)} cells differed).")
+            else:
+                click.echo(f"{len(mismatches)} cells differ; rerun with --repair to rebuild.")
+                raise SystemExit(1)
+
+@app.cli.command("migrate-realdata")
+@without_statement_timeout
+def migrate_realdata():
+    """Move rows from the old one-row-per-size realdata layout into readings."""
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('realdata_long') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                click.echo("Nothing to migrate.")
+                return
+            cur.execute("""
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'realdata_long'::regclass ORDER BY 1
+            """)
+            leaves = [name for name, in cur.fetchall()] or ["realdata_long"]
+            cur.execute("INSERT INTO nodes (name) SELECT DISTINCT node FROM realdata_long WHERE node IS NOT NULL "
+                        "ON CONFLICT (name) DO NOTHING")
+            cur.execute("SELECT MIN(timestamp), MAX(timestamp) FROM realdata_long")
+            oldest, newest = cur.fetchone()
+            if oldest is not None:
+                ensure_partitions(cur, oldest, newest)
+        conn.commit()
+
+    # The rows of one post share node, status and timestamp, so grouping on
+    # them gives back one reading per post; sizes it had no row for stay NULL.
+    counts = sql.SQL(", ").join(
+        sql.SQL("SUM(r.count) FILTER (WHERE b.id = {})").format(sql.Literal(bin_id))
+        for bin_id in range(1, max(SIZE_BIN_IDS.values()) + 1)
+    )
+    for leaf in leaves:
+        # One transaction per table: readers of the realdata view see either
+        # the old rows or the migrated readings, never both.
+        with get_db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("""
+                    INSERT INTO readings (node_id, timestamp, status, counts)
+                    SELECT n.id, r.timestamp, r.status, ARRAY[{counts}]
+                    FROM {leaf} r
+                    JOIN nodes n ON n.name = r.node
+                    JOIN size_bins b ON b.label = r.size_range
+                    WHERE r.timestamp IS NOT NULL AND r.count IS NOT NULL
+                    GROUP BY n.id, r.timestamp, r.status
+                """).format(counts=counts, leaf=sql.Identifier(leaf)))
+                readings = cur.rowcount
+                cur.execute(sql.SQL("""
+                    SELECT COUNT(*), COUNT(*) FILTER (WHERE n.id IS NULL OR b.id IS NULL
+                                                      OR r.timestamp IS NULL OR r.count IS NULL)
+                    FROM {} r
+                    LEFT JOIN nodes n ON n.name = r.node
+                    LEFT JOIN size_bins b ON b.label = r.size_range
+                """).format(sql.Identifier(leaf)))
+                rows, skipped = cur.fetchone()
+                # Dropping the plain table takes the view with it.
+                cur.execute(sql.SQL("DROP TABLE {} CASCADE").format(sql.Identifier(leaf)))
+                create_realdata_view(cur)
+                click.echo(f"{leaf}: {rows} rows -> {readings} readings"
+                           + (f" ({skipped} rows without node, timestamp, count or a known size skipped)" if skipped else ""))
+
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS realdata_long CASCADE")
+            cur.execute("DROP SEQUENCE IF EXISTS realdata_id_seq")
+            create_realdata_view(cur)
+    click.echo("realdata is now served from readings.")
+
+@app.cli.command("retention")
+@click.option("--dry-run", is_flag=True, help="Only report what would be expired and how much space it frees.")
+@without_statement_timeout
+def retention_command(dry_run):
+    """Expire raw rows and minute rollups past their retention."""
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            plan = retention_plan(cur, datetime.now(timezone.utc), exact=True)
+            conn.commit()
+            for line in describe_retention(plan):
+                click.echo(line)
+            if plan and not dry_run:
+                applied = apply_retention(conn, plan)
+                click.echo(f"Done, {len(applied)} of {len(plan)} steps applied"
+                           + ("; the rest were busy, rerun later." if len(applied) < len(plan) else "."))
+
+@app.cli.command("maintenance")
+@without_statement_timeout
+def maintenance_command():
+    """Run the periodic maintenance job (partitions, retention) once."""
+    run_maintenance()
+
+@app.cli.command("backfill-rollups")
+@without_statement_timeout
+def backfill_rollups():
+    """Rebuild the time rollups from realdata."""
+    with get_db_conn() as conn:
+        with conn.cursor() as cur:
+            rebuild_minute_rollup(cur)
+            click.echo(f"realdata_minute: {cur.rowcount} rows")
+            rebuild_daily_rollup(cur)
+            click.echo(f"realdata_daily: {cur.rowcount} rows")
+        conn.commit()
+        publish_data_change(conn)
+
+@app.errorhandler(PoolError)
+def db_pool_exhausted(e):
+    response = jsonify({"error": "Database busy", "details": str(e)})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+@app.errorhandler(QueryCanceled)
+def db_query_cancelled(e):
+    return jsonify({"error": "Database query timed out"}), 503
+
+@app.route('/api/stats')
+def api_stats():
+    if request.headers.get("Authorization", "") != f"Bearer {API_KEY}":
+        return jsonify({"error": "Unauthorized"}), 401
+    stats = {
+        "db_pool": get_pool().stats()
+    }
+    if INGEST_MODE == "queue":
+        stats["ingest_queue"] = get_ingest_queue().stats()
+    if _broadcaster is not None and _broadcaster.pid == os.getpid():
+        stats["stream"] = _broadcaster.stats()
+    if _node_registry is not None and _node_registry.pid == os.getpid():
+        stats["node_registry"] = _node_registry.stats()
+    stats["response_cache"] = get_response_cache().stats()
+    return jsonify(stats)
+
+# Login HTML (you can replace this with your full template later), compiled
+# once; it is the only page with per-request content.
+LOGIN_PAGE = app.jinja_env.from_string("""
     <!DOCTYPE html>
     <html>
     <head>
         <title>Limestone Monitoring Beta</title>
         <style>
             body {
-                background: url('/static/imgs/dashboard.jpg') no-repeat center center fixed;
+                background: url('{{ static_url("imgs/dashboard.jpg") }}') no-repeat center center fixed;
                 background-size: cover;
                 font-family: Arial, sans-serif;
                 display: flex;
@@ -129,15 +1086,17 @@ def login():
         </div>
     </body>
     </html>
-    """
+    """)
 
+@app.route('/', methods=['GET', 'POST'])
+def login():
     if request.method == 'POST':
         if request.form['username'] == USERNAME and request.form['password'] == PASSWORD:
             session['logged_in'] = True
             return redirect('/dashboard')
         else:
-            return render_template_string(html, error="Invalid credentials.")
-    return render_template_string(html)
+            return render_template(LOGIN_PAGE, error="Invalid credentials.")
+    return render_template(LOGIN_PAGE)
 
 
 @app.route('/logout')
@@ -145,50 +1104,1204 @@ def logout():
     session.pop('logged_in', None)
     return redirect('/')
 
+# Size bins, in display order: the label the Pis send, bounds in mm (None
+# when open-ended), the class /api/history groups the bin into, and its chart
+# colour. SIZE_BINS may hold a JSON list of the same shape to change them;
+# init_db() copies them into the size_bins table for SQL-side classification.
+DEFAULT_SIZE_BINS = [
+    {"label": "<30mm", "min_mm": None, "max_mm": 30, "class": "small", "color": "#1f77b4"},
+    {"label": "30-50mm", "min_mm": 30, "max_mm": 50, "class": "small", "color": "#ff7f0e"},
+    {"label": "50-80mm", "min_mm": 50, "max_mm": 80, "class": "large", "color": "#2ca02c"},
+    {"label": "80-150mm", "min_mm": 80, "max_mm": 150, "class": "large", "color": "#d62728"},
+    {"label": ">150mm", "min_mm": 150, "max_mm": None, "class": "large", "color": "#9467bd"},
+]
+
+def load_size_bins():
+    bins = json.loads(os.environ["SIZE_BINS"]) if os.getenv("SIZE_BINS") else DEFAULT_SIZE_BINS
+    keys = {"label", "min_mm", "max_mm", "class", "color"}
+    if not bins or any(set(b) != keys for b in bins):
+        raise ValueError(f"SIZE_BINS must be a non-empty list of objects with keys {sorted(keys)}")
+    if len({b["label"] for b in bins}) != len(bins):
+        raise ValueError("SIZE_BINS labels must be unique")
+    return bins
+
+# Size range covered by each class, e.g. {"small": "<= 50mm", "large": "> 50mm"}.
+def size_class_ranges(bins):
+    ranges = {}
+    for name in dict.fromkeys(b["class"] for b in bins):
+        members = [b for b in bins if b["class"] == name]
+        low = None if any(b["min_mm"] is None for b in members) else min(b["min_mm"] for b in members)
+        high = None if any(b["max_mm"] is None for b in members) else max(b["max_mm"] for b in members)
+        if low is None and high is None:
+            ranges[name] = "all sizes"
+        elif low is None:
+            ranges[name] = f"<= {high}mm"
+        elif high is None:
+            ranges[name] = f"> {low}mm"
+        else:
+            ranges[name] = f"{low}-{high}mm"
+    return ranges
+
+SIZE_BINS = load_size_bins()
+SIZE_LABELS = [b["label"] for b in SIZE_BINS]
+SIZE_BIN_IDS = {}  # label -> size_bins.id, filled by init_db()
+SIZE_CLASS_RANGES = size_class_ranges(SIZE_BINS)
+
+# Ingestion
+ALLOWED_SIZES = set(SIZE_LABELS)
+COPY_MIN_ROWS = int(os.getenv("COPY_MIN_ROWS", "500"))  # switch from VALUES to COPY at this many rows
+BATCH_MAX_READINGS = int(os.getenv("BATCH_MAX_READINGS", "10000"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(32 * 1024 * 1024)))  # after gzip decompression
+BATCH_MAX_CLOCK_SKEW = timedelta(minutes=5)  # readings further in the future are rejected
+MAX_COUNT = 2**31 - 1  # readings.counts is an INTEGER[]
+
+def validate_rock_stats(rock_stats):
+    if not isinstance(rock_stats, dict):
+        return "rock_stats must be a dictionary"
+    if any(size not in ALLOWED_SIZES for size in rock_stats.keys()):
+        return "Invalid size_range in rock_stats"
+    if any(not isinstance(count, int) or isinstance(count, bool) or not 0 <= count <= MAX_COUNT
+           for count in rock_stats.values()):
+        return f"rock_stats counts must be integers from 0 to {MAX_COUNT}"
+    return None
+
+# Checks one post or batch reading before anything is written or queued, so
+# a bad value is a 400 (or a rejected batch item) rather than a database
+# error for the whole request.
+def validate_post(node, status, version, rock_stats):
+    if not isinstance(node, str) or not node:
+        return "node must be a non-empty string"
+    if not isinstance(status, str) or not status:
+        return "status must be a non-empty string"
+    if version is not None and not isinstance(version, str):
+        return "version must be a string"
+    return validate_rock_stats(rock_stats)
+
+# Takes realdata rows (node, status, timestamp, size_range, count), writes
+# them as one readings row per post, adds them to node_totals and the
+# minute/daily rollups and moves each node's last_seen forward, commits, then
+# publishes the change. Small posts go out as one round trip, which on an
+# autocommit connection still runs as a single transaction. Large batches are
+# streamed with COPY and need a transaction to stay atomic.
+#
+# Rows from before the last /reset are stored like any other, as archived
+# readings: the realdata view hides them and they count towards neither
+# node_totals, the rollups nor last_seen, all of which the reset cleared.
+def ingest_rows(conn, rows):
+    # The guard in write_rows() has the final word, so the listener's cached
+    # cutoff is enough here; falling back to a query would need a second
+    # connection while the caller holds one.
+    if not rows:
+        return
+    state = get_broadcaster().state
+    reset_at = state[2] if state else None
+    while True:
+        ok, reset_at, newest = write_rows(conn, rows, reset_at)
+        if ok:
+            break
+        # The cutoff changed since reset_at was read; nothing was written.
+        conn.rollback()
+
+    conn.commit()
+    # Archived rows must not move the newest reading back behind the reset.
+    if newest is None:
+        publish_data_change(conn)
+    else:
+        publish_data_change(conn, last_update=newest.isoformat())
+
+# The single statement behind ingest_rows(), counting only the rows from
+# reset_at on. Its guard re-reads reset_at with the statement's own snapshot,
+# taken after any /reset holding node_totals has committed, and every write is
+# skipped if that cutoff splits the rows differently. Returns whether they
+# were written, the reset_at the statement saw and the newest counted
+# reading (None if every row was archived).
+def write_rows(conn, rows, reset_at):
+    readings, totals, minutes, days, seen, first_counted, last_archived = tally_rows(rows, reset_at)
+    with conn.cursor() as cur:
+        ctes = [cur.mogrify("""
+                guard AS (
+                    SELECT reset_at,
+                           COALESCE((reset_at IS NULL OR %(first)s::timestamptz IS NULL OR reset_at <= %(first)s)
+                                    AND (%(last)s::timestamptz IS NULL OR %(last)s < reset_at), false) AS ok
+                    FROM (SELECT (SELECT value::timestamptz FROM meta WHERE key = 'reset_at') AS reset_at) r
+                )""", {"first": first_counted, "last": last_archived})]
+        node_ids = lookup_node_ids(cur, {node for node, _, _ in readings})
+        readings = [(node_ids[node], timestamp, status, counts) for (node, status, timestamp), counts in readings.items()]
+        if len(readings) >= COPY_MIN_ROWS:
+            copy_readings(cur, readings)
+        else:
+            ctes.append(b"""
+                inserted AS (
+                    INSERT INTO readings (node_id, timestamp, status, counts)
+                    """ + guarded_values(cur, readings) + b"""
+                )""")
+        if totals:
+            ctes.append(upsert_sums(cur, b"totals", b"node_totals", b"node, size_range", totals,
+                                    b", changed_xid = pg_current_xact_id()"))
+            ctes.append(upsert_sums(cur, b"minutes", b"realdata_minute", b"minute, node, size_range", minutes))
+            ctes.append(upsert_sums(cur, b"days", b"realdata_daily", b"day, node, size_range", days))
+            # Only the posting nodes' rows are touched, in id order like the
+            # rollups, and only when the reading is newer, so backlog uploads
+            # leave no dead tuples behind. Ids are always given, so the upsert
+            # never draws from the nodes sequence.
+            seen_rows = sorted((node_ids[node], node, timestamp) for node, timestamp in seen.items())
+            ctes.append(b"""
+                seen AS (
+                    INSERT INTO nodes (id, name, last_seen)
+                    """ + guarded_values(cur, seen_rows) + b"""
+                    ON CONFLICT (id) DO UPDATE SET last_seen = EXCLUDED.last_seen
+                    WHERE nodes.last_seen IS NULL OR nodes.last_seen < EXCLUDED.last_seen
+                )""")
+        # Data-modifying CTEs run whether or not the query reads them.
+        cur.execute(b"WITH " + b",".join(ctes) + b" SELECT ok, reset_at FROM guard")
+        ok, reset_at = cur.fetchone()
+    if ok:
+        _node_ids.update(node_ids)
+    return ok, reset_at, max(seen.values(), default=None)
+
+# Groups rows into readings (node, status, timestamp) -> counts by size bin
+# id, and sums the rows from reset_at on per node_totals, minute and day key.
+# Also returns each node's newest counted reading, the oldest counted and the
+# newest archived timestamp, which the guard in write_rows() checks.
+def tally_rows(rows, reset_at):
+    bins = max(SIZE_BIN_IDS.values())
+    readings = {}
+    totals = defaultdict(int)
+    minutes = defaultdict(int)
+    days = defaultdict(int)
+    seen = {}
+    first_counted = last_archived = None
+    for node, status, timestamp, size_range, count in rows:
+        counts = readings.get((node, status, timestamp))
+        if counts is None:
+            # Bins the post did not send stay NULL, so realdata only
+            # shows the sizes that were reported.
+            counts = readings[(node, status, timestamp)] = [None] * bins
+        i = SIZE_BIN_IDS[size_range] - 1
+        counts[i] = (counts[i] or 0) + count
+        if reset_at is not None and timestamp < reset_at:
+            if last_archived is None or timestamp > last_archived:
+                last_archived = timestamp
+            continue
+        if first_counted is None or timestamp < first_counted:
+            first_counted = timestamp
+        if node not in seen or timestamp > seen[node]:
+            seen[node] = timestamp
+        totals[(node, size_range)] += count
+        minute = timestamp.astimezone(timezone.utc).replace(second=0, microsecond=0)
+        minutes[(minute, node, size_range)] += count
+        # pytz applies the Cairo offset in force at that instant (DST aware).
+        days[(timestamp.astimezone(EGYPT_TZ).date(), node, size_range)] += count
+    return readings, totals, minutes, days, seen, first_counted, last_archived
+
+# Node name -> nodes.id. Only ids of committed nodes are cached, so a rolled
+# back ingest cannot leave a dangling id behind.
+_node_ids = {}
+
+def lookup_node_ids(cur, names):
+    ids = {name: _node_ids[name] for name in names if name in _node_ids}
+    missing = sorted(set(names) - ids.keys())
+    while missing:
+        # Rows committed by a concurrent insert after this statement's
+        # snapshot show up in neither branch; the next round finds them.
+        cur.execute("""
+            WITH created AS (
+                INSERT INTO nodes (name) SELECT unnest(%s::text[]) ON CONFLICT (name) DO NOTHING
+                RETURNING name, id
+            )
+            SELECT name, id FROM created
+            UNION ALL
+            SELECT name, id FROM nodes WHERE name = ANY(%s::text[])
+        """, (missing, missing))
+        ids.update(cur.fetchall())
+        missing = sorted(set(names) - ids.keys())
+    return ids
+
+# CTE adding per-key sums to a rollup table. Keys are sorted so concurrent
+# ingests lock rollup rows in the same order and cannot deadlock.
+def upsert_sums(cur, name, table, key_columns, sums, extra_set=b""):
+    rows = [(*key, sums[key]) for key in sorted(sums)]
+    return b"""
+                %s AS (
+                    INSERT INTO %s (%s, total)
+                    %s
+                    ON CONFLICT (%s) DO UPDATE SET total = %s.total + EXCLUDED.total%s
+                )""" % (name, table, key_columns, guarded_values(cur, rows), key_columns, table, extra_set)
+
+def sql_values(cur, rows):
+    placeholders = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+    return b",".join(cur.mogrify(placeholders, row) for row in rows)
+
+# Rows for an INSERT in write_rows(), kept only if its guard lets them through.
+def guarded_values(cur, rows):
+    return b"SELECT * FROM (VALUES " + sql_values(cur, rows) + b") v WHERE (SELECT ok FROM guard)"
+
+def copy_readings(cur, readings):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for node_id, timestamp, status, counts in readings:
+        writer.writerow((node_id, timestamp.isoformat(), status,
+                         "{" + ",".join("NULL" if count is None else str(count) for count in counts) + "}"))
+    buf.seek(0)
+    with blocking_io():
+        cur.copy_expert(
+            "COPY readings (node_id, timestamp, status, counts) FROM STDIN WITH (FORMAT csv)",
+            buf
+        )
+
+def read_batch_body():
+    raw = request.get_data(cache=False)
+    if request.content_encoding == "gzip":
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        try:
+            raw = decompressor.decompress(raw, BATCH_MAX_BYTES)
+        except zlib.error:
+            raise ValueError("Invalid gzip body")
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed body too large")
+    elif request.content_encoding not in (None, "identity"):
+        raise ValueError(f"Unsupported Content-Encoding: {request.content_encoding}")
+    if len(raw) > BATCH_MAX_BYTES:
+        raise ValueError("Body too large")
+    try:
+        return json.loads(raw)
+    except ValueError:
+        raise ValueError("Body is not valid JSON")
+
+def parse_batch_reading(item, now):
+    if not isinstance(item, dict):
+        raise ValueError("reading must be an object")
+    node = item.get("node", "unknown-node")
+    status = item.get("status", "unknown")
+    version = item.get("version")
+    rock_stats = item.get("rock_stats", {})
+    error = validate_post(node, status, version, rock_stats)
+    if error:
+        raise ValueError(error)
+    if not isinstance(item.get("timestamp"), str):
+        raise ValueError("timestamp is required")
+    try:
+        timestamp = parser.isoparse(item["timestamp"])
+    except ValueError:
+        raise ValueError("timestamp must be ISO-8601")
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    if timestamp > now + BATCH_MAX_CLOCK_SKEW:
+        raise ValueError("timestamp is in the future")
+    rows = [(node, status, timestamp, size_range, count) for size_range, count in rock_stats.items()]
+    return rows, node, status, version, timestamp
+
+# Write-behind ingestion (INGEST_MODE=queue): /update only validates and
+# enqueues; a background flusher group-commits everything pending once
+# INGEST_FLUSH_ROWS rows have piled up or the oldest post has waited
+# INGEST_FLUSH_INTERVAL seconds. A full queue answers 429, and the queue is
+# drained when the worker exits.
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+INGEST_QUEUE_MAX = int(os.getenv("INGEST_QUEUE_MAX", "10000"))  # posts held in memory
+INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", "1000"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "0.5"))
+INGEST_DRAIN_TIMEOUT = float(os.getenv("INGEST_DRAIN_TIMEOUT", "20"))
+
+class IngestQueue:
+    def __init__(self, max_posts, flush_rows, flush_interval):
+        self.max_posts = max_posts
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._pending = deque()  # (rows, timestamp, enqueued_at)
+        self._pending_rows = 0
+        self._stopping = False
+        self._stats = defaultdict(int)
+        self._thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+        self._thread.start()
+
+    def put(self, rows, timestamp):
+        with self._cond:
+            if self._stopping or len(self._pending) >= self.max_posts:
+                self._stats["rejected"] += 1
+                return False
+            self._pending.append((rows, timestamp, time.monotonic()))
+            self._pending_rows += len(rows)
+            self._stats["queued"] += 1
+            # The flusher sleeps until the first post arrives, then until the
+            # oldest one is due or enough rows have piled up.
+            if len(self._pending) == 1 or self._pending_rows >= self.flush_rows:
+                self._cond.notify()
+            return True
+
+    def _run(self):
+        backoff = self.flush_interval
+        while True:
+            with self._cond:
+                while not self._stopping and self._pending_rows < self.flush_rows:
+                    if not self._pending:
+                        self._cond.wait(self.flush_interval)
+                        continue
+                    remaining = self._pending[0][2] + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if not self._pending:
+                    return
+                # Only this thread removes items, so the snapshot stays at the
+                # front of the deque while it is being written.
+                batch = list(self._pending)
+
+            done = self._flush(batch)
+            with self._cond:
+                for _ in range(done):
+                    rows, _, _ = self._pending.popleft()
+                    self._pending_rows -= len(rows)
+                if done == len(batch):
+                    backoff = self.flush_interval
+                    continue
+                if self._stopping:
+                    self._stats["lost_on_shutdown"] += len(self._pending)
+                    return
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    # Returns how many posts from the front of the batch are done with,
+    # written or dropped; the rest is retried once the database is back.
+    def _flush(self, batch):
+        try:
+            self._write(batch)
+        except (psycopg2.OperationalError, PoolError):
+            self._stats["flush_failures"] += 1
+            app.logger.exception("Ingest flush failed; will retry")
+            return 0
+        except Exception:
+            # Something in the batch was rejected, by the database or while
+            # building the statement; write the posts one by one so a single
+            # bad post can neither wedge the queue nor kill this thread.
+            for done, post in enumerate(batch):
+                try:
+                    self._write([post])
+                except (psycopg2.OperationalError, PoolError):
+                    self._stats["flush_failures"] += 1
+                    app.logger.exception("Ingest flush failed; will retry")
+                    return done
+                except Exception:
+                    self._stats["dropped"] += 1
+                    app.logger.exception("Dropping queued post that cannot be written")
+        self._stats["flushes"] += 1
+        self._stats["flushed_posts"] += len(batch)
+        return len(batch)
+
+    def _write(self, posts):
+        rows = [row for post_rows, _, _ in posts for row in post_rows]
+        with get_db_conn() as conn:
+            ingest_rows(conn, rows)
+
+    def drain(self, timeout):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending_posts": len(self._pending),
+                "pending_rows": self._pending_rows,
+                "max_posts": self.max_posts,
+                **self._stats,
+            }
+
+
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+
+def get_ingest_queue():
+    global _ingest_queue
+    if _ingest_queue is None or _ingest_queue.pid != os.getpid():
+        with _ingest_queue_lock:
+            if _ingest_queue is None or _ingest_queue.pid != os.getpid():
+                _ingest_queue = IngestQueue(INGEST_QUEUE_MAX, INGEST_FLUSH_ROWS, INGEST_FLUSH_INTERVAL)
+    return _ingest_queue
+
+@atexit.register
+def drain_ingest_queue():
+    if _ingest_queue is not None and _ingest_queue.pid == os.getpid():
+        _ingest_queue.drain(INGEST_DRAIN_TIMEOUT)
+
+# Node registry: each node's last status, firmware version, last-seen time
+# and posting rate, recorded in memory by /update and /update/batch and
+# written to nodes every NODE_FLUSH_INTERVAL seconds by one thread per
+# worker. The rate is an exponentially decayed post count with time constant
+# NODE_RATE_WINDOW; such counts add up, so workers can merge theirs into the
+# same row. A node is stale once nothing has arrived from it for
+# NODE_STALE_AFTER seconds.
+NODE_FLUSH_INTERVAL = float(os.getenv("NODE_FLUSH_INTERVAL", "5"))
+NODE_RATE_WINDOW = float(os.getenv("NODE_RATE_WINDOW", "300"))
+NODE_STALE_AFTER = float(os.getenv("NODE_STALE_AFTER", "120"))
+
+class NodeRegistry:
+    def __init__(self, flush_interval, rate_window):
+        self.flush_interval = flush_interval
+        self.rate_window = rate_window
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        # node -> {"status", "version", "reported_at", "posts", "posts_at"};
+        # only what has not been flushed yet.
+        self._pending = {}
+        self._stats = defaultdict(int)
+        self._thread = threading.Thread(target=self._run, name="node-registry", daemon=True)
+        self._thread.start()
+
+    def _decay(self, posts, seconds):
+        return posts * math.exp(-max(0.0, seconds) / self.rate_window)
+
+    def record(self, node, status, version, timestamp):
+        now = time.time()
+        # Backlog readings count for what they would have weighed by now.
+        entry = {"status": status, "version": version, "reported_at": timestamp,
+                 "posts": self._decay(1.0, now - timestamp.timestamp()), "posts_at": now}
+        with self._lock:
+            older = self._pending.get(node)
+            self._pending[node] = entry if older is None else self._merge(older, entry)
+
+    def _merge(self, a, b):
+        if a["posts_at"] > b["posts_at"]:
+            a, b = b, a
+        posts = self._decay(a["posts"], b["posts_at"] - a["posts_at"]) + b["posts"]
+        newest, other = (a, b) if a["reported_at"] > b["reported_at"] else (b, a)
+        return {"status": newest["status"], "version": newest["version"] or other["version"],
+                "reported_at": newest["reported_at"], "posts": posts, "posts_at": b["posts_at"]}
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            with get_db_conn() as conn:
+                with conn.cursor() as cur:
+                    node_ids = lookup_node_ids(cur, pending)
+                    rows = sorted((node_ids[node], node, e["status"], e["version"], e["reported_at"], e["posts"],
+                                   datetime.fromtimestamp(e["posts_at"], timezone.utc))
+                                  for node, e in pending.items())
+                    window = cur.mogrify("%s", (self.rate_window,))
+                    # Ids in order, as in ingest_rows(). Each side's count is
+                    # decayed to the later of the two times before adding.
+                    cur.execute(b"""
+                        INSERT INTO nodes AS n (id, name, status, version, reported_at, post_rate, rate_at)
+                        VALUES """ + sql_values(cur, rows) + b"""
+                        ON CONFLICT (id) DO UPDATE SET
+                            status = CASE WHEN n.reported_at > EXCLUDED.reported_at THEN n.status
+                                          ELSE EXCLUDED.status END,
+                            version = CASE WHEN n.reported_at > EXCLUDED.reported_at OR EXCLUDED.version IS NULL
+                                           THEN n.version ELSE EXCLUDED.version END,
+                            reported_at = GREATEST(n.reported_at, EXCLUDED.reported_at),
+                            post_rate = EXCLUDED.post_rate * exp(-GREATEST(EXTRACT(EPOCH FROM n.rate_at - EXCLUDED.rate_at), 0) / """ + window + b""")
+                                      + COALESCE(n.post_rate * exp(-GREATEST(EXTRACT(EPOCH FROM EXCLUDED.rate_at - n.rate_at), 0) / """ + window + b"""), 0),
+                            rate_at = GREATEST(n.rate_at, EXCLUDED.rate_at)
+                    """)
+                conn.commit()
+            _node_ids.update(node_ids)
+            self._stats["flushes"] += 1
+            self._stats["flushed_nodes"] += len(pending)
+        except (psycopg2.Error, PoolError):
+            self._stats["flush_failures"] += 1
+            app.logger.exception("Node registry flush failed; will retry")
+            with self._lock:
+                for node, entry in pending.items():
+                    newer = self._pending.get(node)
+                    self._pending[node] = entry if newer is None else self._merge(entry, newer)
+
+    # Rows of nodes (name, status, version, reported_at, last_seen,
+    # post_rate, rate_at) merged with what this worker has not flushed yet.
+    # One pass over the nodes, whatever the data volume.
+    def describe(self, rows, now):
+        with self._lock:
+            pending = dict(self._pending)
+        nodes = []
+        for name, status, version, reported_at, last_seen, post_rate, rate_at in rows:
+            posts = self._decay(post_rate, (now - rate_at).total_seconds()) if rate_at else 0.0
+            entry = pending.pop(name, None)
+            if entry is not None:
+                posts += self._decay(entry["posts"], now.timestamp() - entry["posts_at"])
+                if reported_at is None or entry["reported_at"] >= reported_at:
+                    status, reported_at = entry["status"], entry["reported_at"]
+                    version = entry["version"] or version
+            seen = max(filter(None, (last_seen, reported_at)), default=None)
+            age = (now - seen).total_seconds() if seen else None
+            nodes.append({
+                "node": name,
+                "status": status,
+                "version": version,
+                "last_seen": seen.isoformat() if seen else None,
+                "seconds_since_seen": round(age, 1) if age is not None else None,
+                "posts_per_min": round(posts / self.rate_window * 60, 2),
+                "stale": age is None or age > NODE_STALE_AFTER,
+            })
+        return nodes
+
+    def stats(self):
+        with self._lock:
+            return {"pending_nodes": len(self._pending), **self._stats}
+
+
+_node_registry = None
+_node_registry_lock = threading.Lock()
+
+def get_node_registry():
+    global _node_registry
+    if _node_registry is None or _node_registry.pid != os.getpid():
+        with _node_registry_lock:
+            if _node_registry is None or _node_registry.pid != os.getpid():
+                _node_registry = NodeRegistry(NODE_FLUSH_INTERVAL, NODE_RATE_WINDOW)
+    return _node_registry
+
+@atexit.register
+def flush_node_registry():
+    if _node_registry is not None and _node_registry.pid == os.getpid():
+        _node_registry.flush()
+
+@app.route('/api/nodes')
+def api_nodes():
+    if not session.get('logged_in') and request.headers.get("Authorization", "") != f"Bearer {API_KEY}":
+        return jsonify({"error": "Unauthorized"}), 401
+    with get_db_conn(DB_READ_TIMEOUT_MS) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT name, status, version, reported_at, last_seen, post_rate, rate_at FROM nodes ORDER BY name")
+            rows = cur.fetchall()
+    nodes = get_node_registry().describe(rows, datetime.now(timezone.utc))
+    return jsonify({
+        "nodes": nodes,
+        "stale": sum(node["stale"] for node in nodes),
+        "stale_after": NODE_STALE_AFTER,
+    })
+
 @app.route('/update', methods=['POST'])
 def update():
     if request.headers.get("Authorization", "") != f"Bearer {API_KEY}":
         return jsonify({"error": "Unauthorized"}), 401
 
     data = request.json or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
     node = data.get("node", "unknown-node")
     status = data.get("status", "unknown")
+    version = data.get("version")
     rock_stats = data.get("rock_stats", {})
 
-    if not isinstance(rock_stats, dict):
-        return jsonify({"error": "rock_stats must be a dictionary"}), 400
-
-    allowed_sizes = {"<30mm", "30-50mm", "50-80mm", "80-150mm", ">150mm"}
-    if any(size not in allowed_sizes for size in rock_stats.keys()):
-        return jsonify({"error": "Invalid size_range in rock_stats"}), 400
+    error = validate_post(node, status, version, rock_stats)
+    if error:
+        return jsonify({"error": error}), 400
 
     timestamp = datetime.now(timezone.utc)
 
+    rows = [(node, status, timestamp, size_range, count) for size_range, count in rock_stats.items()]
+
+    if INGEST_MODE == "queue":
+        if not get_ingest_queue().put(rows, timestamp):
+            response = jsonify({"error": "Ingest queue full, retry later"})
+            response.headers["Retry-After"] = str(max(1, round(INGEST_FLUSH_INTERVAL)))
+            return response, 429
+        get_node_registry().record(node, status, version, timestamp)
+        return jsonify({"message": "Data queued.", "timestamp": timestamp.isoformat()}), 202
+
     try:
-        with get_db_conn() as conn:
-            with conn.cursor() as cur:
-                for size_range, count in rock_stats.items():
-                    cur.execute(
-                        "INSERT INTO realdata (node, status, timestamp, size_range, count) VALUES (%s, %s, %s, %s, %s)",
-                        (node, status, timestamp, size_range, count)
-                    )
-                cur.execute("INSERT INTO meta (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
-                            ("last_update", timestamp.isoformat()))
-                conn.commit()
+        with get_db_conn(autocommit=True) as conn:
+            ingest_rows(conn, rows)
     except Exception as e:
         return jsonify({"error": "Database error", "details": str(e)}), 500
-
-    for q in subscribers:
-        q.put("update")  # Sends to /stream listeners
+    get_node_registry().record(node, status, version, timestamp)
 
     return jsonify({"message": "Data saved.", "timestamp": timestamp.isoformat()}), 200
 
+# Backlog upload for Pis that were offline: a JSON array (optionally gzipped)
+# of {"node", "status", "timestamp", "rock_stats"} readings, stored with their
+# own timestamps in one transaction. Invalid readings are skipped and reported
+# by index.
+@app.route('/update/batch', methods=['POST'])
+def update_batch():
+    if request.headers.get("Authorization", "") != f"Bearer {API_KEY}":
+        return jsonify({"error": "Unauthorized"}), 401
 
-@app.route('/dashboard')
-def dashboard():
+    try:
+        readings = read_batch_body()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if isinstance(readings, dict):
+        readings = readings.get("readings")
+    if not isinstance(readings, list):
+        return jsonify({"error": "Expected a list of readings"}), 400
+    if len(readings) > BATCH_MAX_READINGS:
+        return jsonify({"error": f"At most {BATCH_MAX_READINGS} readings per batch"}), 413
+
+    now = datetime.now(timezone.utc)
+    rows = []
+    accepted = []
+    rejected = []
+    last_update = None
+    for index, item in enumerate(readings):
+        try:
+            item_rows, node, status, version, timestamp = parse_batch_reading(item, now)
+        except ValueError as e:
+            rejected.append({"index": index, "error": str(e)})
+            continue
+        rows.extend(item_rows)
+        accepted.append((node, status, version, timestamp))
+        if last_update is None or timestamp > last_update:
+            last_update = timestamp
+
+    if last_update is not None:
+        try:
+            with get_db_conn() as conn:
+                with conn.cursor() as cur:
+                    # A missing partition is created under readings' exclusive
+                    # lock; rather than queue every /update behind an export
+                    # holding readings, give up and let the Pi retry.
+                    cur.execute("SET LOCAL lock_timeout = %s", (MAINTENANCE_LOCK_TIMEOUT_MS,))
+                    ensure_partitions(cur, min(timestamp for *_, timestamp in accepted), last_update)
+            with get_db_conn() as conn:
+                ingest_rows(conn, rows)
+        except psycopg2.errors.LockNotAvailable:
+            response = jsonify({"error": "Database busy, retry the batch"})
+            response.headers["Retry-After"] = "5"
+            return response, 503
+        except Exception as e:
+            return jsonify({"error": "Database error", "details": str(e)}), 500
+        registry = get_node_registry()
+        for node, status, version, timestamp in accepted:
+            registry.record(node, status, version, timestamp)
+
+    return jsonify({
+        "accepted": len(readings) - len(rejected),
+        "rows": len(rows),
+        "rejected": rejected
+    }), 200
+
+
+# Live updates (/stream). Ingest and reset NOTIFY UPDATES_CHANNEL; each worker
+# keeps one LISTEN connection and fans notifications out to its Server-Sent
+# Events clients, so a post handled by any worker reaches every viewer. The
+# same notifications keep each worker's copy of the data version current.
+UPDATES_CHANNEL = "realdata_updates"
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "20"))  # seconds between keepalive comments
+SSE_CLIENT_QUEUE = int(os.getenv("SSE_CLIENT_QUEUE", "16"))  # undelivered events kept per client
+SSE_MAX_CLIENTS = int(os.getenv("SSE_MAX_CLIENTS", "500"))  # per worker
+
+# Advances the shared data version and notifies listeners. Call it after the
+# change has committed: readers take the version before they query, so data
+# they read is never older than the version they report. Failures are only
+# logged, since the change itself is already durable and must not be retried;
+# readers catch up with the next change.
+def publish_data_change(conn, **event):
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT pg_notify(%s, (%s::jsonb || jsonb_build_object('version', nextval('data_version_seq')))::text)",
+                (UPDATES_CHANNEL, json.dumps(event))
+            )
+        conn.commit()
+    except psycopg2.Error:
+        app.logger.exception("Could not publish data change")
+        if not conn.closed:
+            conn.rollback()
+
+class UpdateBroadcaster:
+    def __init__(self, connect_kwargs):
+        self.connect_kwargs = connect_kwargs
+        self.pid = os.getpid()
+        # (data version, newest reading time, last reset); None while not
+        # connected.
+        self.state = None
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._thread = threading.Thread(target=self._listen, name="update-listener", daemon=True)
+        self._thread.start()
+
+    def subscribe(self):
+        with self._lock:
+            if len(self._clients) >= SSE_MAX_CLIENTS:
+                return None
+            q = queue.Queue(maxsize=SSE_CLIENT_QUEUE)
+            self._clients.add(q)
+            return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._clients.discard(q)
+
+    def publish(self, payload):
+        with self._lock:
+            clients = list(self._clients)
+        for q in clients:
+            # A slow client loses its oldest event rather than growing without
+            # bound; every event means "refetch", so nothing is lost.
+            while True:
+                try:
+                    q.put_nowait(payload)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connect_kwargs)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(UPDATES_CHANNEL)))
+                    # Read after LISTEN so no change can slip in between.
+                    self.state = read_data_state(cur)
+                backoff = 1
+                while True:
+                    select.select([conn], [], [], SSE_HEARTBEAT)
+                    conn.poll()
+                    while conn.notifies:
+                        payload = conn.notifies.pop(0).payload
+                        self.state = self._apply(self.state, json.loads(payload))
+                        self.publish(payload)
+            except Exception:
+                app.logger.exception("Update listener lost its connection; reconnecting")
+            finally:
+                self.state = None
+                if conn is not None:
+                    conn.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    @staticmethod
+    def _apply(state, event):
+        version, last_update, reset_at = state
+        if event.get("reset"):
+            last_update = None
+            reset_at = datetime.fromisoformat(event["reset_at"])
+        elif event.get("last_update"):
+            seen = datetime.fromisoformat(event["last_update"])
+            if last_update is None or seen > last_update:
+                last_update = seen
+        return max(version, event.get("version", 0)), last_update, reset_at
+
+    def stats(self):
+        with self._lock:
+            return {"clients": len(self._clients)}
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+def get_broadcaster():
+    global _broadcaster
+    if _broadcaster is None or _broadcaster.pid != os.getpid():
+        with _broadcaster_lock:
+            if _broadcaster is None or _broadcaster.pid != os.getpid():
+                _broadcaster = UpdateBroadcaster(get_pool().connect_kwargs)
+    return _broadcaster
+
+def read_data_state(cur):
+    cur.execute('''
+        SELECT (SELECT last_value FROM data_version_seq), (SELECT MAX(last_seen) FROM nodes),
+               (SELECT value::timestamptz FROM meta WHERE key = 'reset_at')
+    ''')
+    return cur.fetchone()
+
+# The data version, the time of the newest reading and of the last /reset,
+# from the listener's cache so read endpoints need no query for them; from
+# the database while the listener is reconnecting.
+def data_state():
+    state = get_broadcaster().state
+    if state is None:
+        with get_db_conn(autocommit=True) as conn:
+            with conn.cursor() as cur:
+                state = read_data_state(cur)
+    return state
+
+def data_version():
+    return data_state()[0]
+
+def data_last_update():
+    return data_state()[1]
+
+def data_reset_at():
+    return data_state()[2]
+
+# Conditional GET for read APIs: the ETag is the data version (plus whatever
+# else the response depends on, from etag_extra), so a client that already
+# has the current data gets a 304 before any query runs. There is no
+# Last-Modified: several ingests can land within its one-second resolution.
+# Other requests are served from the response cache, keyed by path, query
+# string and ETag, so viewers polling the same data share one computation.
+# The compressed body is cached too, under the same key plus the encoding;
+# the ETag is then weak, as the bytes differ between encodings.
+def conditional_on_data_version(etag_extra=None):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = str(data_version())
+            if etag_extra is not None:
+                etag += "-" + etag_extra()
+            weak = False
+            if request.if_none_match.contains_weak(etag):
+                # Echo the tag in the form the client holds it.
+                weak = not request.if_none_match.contains(etag)
+                response = Response(status=304)
+            else:
+                encoding = None
+                def render():
+                    rendered = make_response(view(*args, **kwargs))
+                    return rendered.status_code, rendered.mimetype, rendered.get_data()
+                cache = get_response_cache()
+                key = f"{request.path}?{sorted(request.args.items(multi=True))}#{etag}"
+                status, mimetype, body = cache.get_or_compute(key, render)
+                if status == 200 and len(body) >= COMPRESS_MIN_BYTES:
+                    encoding = response_encoding()
+                if encoding is not None:
+                    _, _, body = cache.get_or_compute(f"{key}|{encoding}",
+                                                      lambda: (status, mimetype, compress_body(body, encoding)))
+                response = Response(body, status=status, mimetype=mimetype)
+                if status != 200:
+                    return response
+                if encoding is not None:
+                    response.headers["Content-Encoding"] = encoding
+                    weak = True
+            response.set_etag(etag, weak=weak)
+            response.headers["Cache-Control"] = "no-cache"
+            response.vary.add("Accept-Encoding")
+            return response
+        return wrapper
+    return decorator
+
+# Negotiated compression of JSON responses: brotli when the client accepts it
+# and the module is installed, otherwise gzip. Bodies under
+# COMPRESS_MIN_BYTES are sent as they are. Responses of the cached read APIs
+# are compressed once per data version (see above), the rest per request.
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+def response_encoding():
+    return request.accept_encodings.best_match(["br", "gzip"] if brotli is not None else ["gzip"])
+
+def compress_body(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return zlib.compress(body, GZIP_LEVEL, wbits=31)  # gzip container
+
+@app.after_request
+def compress_json(response):
+    if response.mimetype != "application/json" or response.is_streamed:
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    body = response.get_data()
+    encoding = response_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding is None:
+        return response
+    response.set_data(compress_body(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Response cache. "memory" keeps entries per worker; "sqlite" shares them
+# between the workers on one host through a SQLite file (put it on tmpfs).
+# Entries expire after RESPONSE_CACHE_TTL seconds and the least recently used
+# are evicted beyond RESPONSE_CACHE_SIZE; since keys include the data version,
+# an ingest simply makes older entries unreachable.
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "memory")  # memory | sqlite | off
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH",
+                                os.path.join(tempfile.gettempdir(), "rock-dashboard-cache.sqlite3"))
+RESPONSE_CACHE_WAIT = 10  # seconds to wait for another request computing the same entry
+
+# Single-flight cache of (status, mimetype, body) tuples: concurrent misses
+# on one key in a worker wait for the first request to compute it. Only 200
+# and 204 responses are stored.
+class ResponseCache:
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._stats = defaultdict(int)
+
+    def get_or_compute(self, key, compute):
+        while True:
+            value = self._load(key)
+            if value is not None:
+                self._count("hits")
+                return value
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+            self._count("waits")
+            event.wait(RESPONSE_CACHE_WAIT)
+        try:
+            self._count("misses")
+            value = self._compute(key, compute)
+            if value[0] in (200, 204):
+                self._store(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def _compute(self, key, compute):
+        return compute()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def stats(self):
+        with self._lock:
+            return {"backend": RESPONSE_CACHE, **self._stats}
+
+
+class MemoryResponseCache(ResponseCache):
+    def __init__(self, max_entries, ttl):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires, value), oldest use first
+
+    def _load(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats["entries"] = len(self._entries)
+        return stats
+
+
+# Cache shared by the workers on one host. A lease row stops other workers
+# from computing an entry that one of them is already computing; they poll
+# for the result instead, and compute it themselves if the lease holder does
+# not finish in time. Hits only read: an entry's last use is written back at
+# most once a tenth of the TTL, which is all the precision eviction needs.
+#
+# sqlite3 blocks in C, for up to 5 s while another worker holds the write
+# lock. Under the gevent worker every call therefore runs on the hub's
+# thread pool, so only the calling greenlet waits; _db_lock (a gevent lock
+# then) keeps the calls on the shared connection one at a time.
+class SqliteResponseCache(ResponseCache):
+    def __init__(self, path, max_entries, ttl):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.touch_interval = ttl / 10
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._run(self._create)
+
+    def _run(self, fn, *args):
+        with self._db_lock:
+            if gevent_patched():
+                return get_hub().threadpool.apply(fn, args)
+            return fn(*args)
+
+    def _create(self):
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, status INTEGER, mimetype TEXT, body BLOB,
+                expires REAL, used REAL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, expires REAL)")
+
+    def _load(self, key):
+        return self._run(self._select, key, time.time())
+
+    def _select(self, key, now):
+        row = self._db.execute("SELECT status, mimetype, body, used FROM responses WHERE key = ? AND expires > ?",
+                               (key, now)).fetchone()
+        if row is None:
+            return None
+        if row[3] < now - self.touch_interval:
+            self._db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+        return row[:3]
+
+    def _store(self, key, value):
+        self._count("evictions", self._run(self._insert, key, value, time.time()))
+
+    def _insert(self, key, value, now):
+        self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, *value, now + self.ttl, now))
+        return self._db.execute("""
+            DELETE FROM responses WHERE expires <= ? OR key IN (
+                SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?
+            )
+        """, (now, self.max_entries)).rowcount
+
+    def _compute(self, key, compute):
+        now = time.time()
+        leased = self._run(self._lease, key, now)
+        if not leased:
+            self._count("waits")
+            deadline = time.monotonic() + RESPONSE_CACHE_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                value = self._load(key)
+                if value is not None:
+                    return value
+            return compute()
+        try:
+            return compute()
+        finally:
+            self._run(self._db.execute, "DELETE FROM leases WHERE key = ?", (key,))
+
+    def _lease(self, key, now):
+        return self._db.execute("""
+            INSERT INTO leases VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET expires = excluded.expires WHERE leases.expires <= ?
+        """, (key, now + RESPONSE_CACHE_WAIT, now)).rowcount
+
+    def stats(self):
+        stats = super().stats()
+        stats["entries"] = self._run(lambda: self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0])
+        return stats
+
+
+class NoResponseCache(ResponseCache):
+    def get_or_compute(self, key, compute):
+        self._count("misses")
+        return compute()
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    global _response_cache
+    if _response_cache is None or _response_cache.pid != os.getpid():
+        with _response_cache_lock:
+            if _response_cache is None or _response_cache.pid != os.getpid():
+                if RESPONSE_CACHE == "sqlite":
+                    _response_cache = SqliteResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+                elif RESPONSE_CACHE == "memory":
+                    _response_cache = MemoryResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+                else:
+                    _response_cache = NoResponseCache()
+    return _response_cache
+
+# --- Static files and page shells ---
+# Files under /static are linked as /static/<file>?v=<hash of the file>, and
+# only such URLs are cached for a year; plain ones revalidate against the
+# ETag every time. The chart pages have no per-request content: each is
+# rendered once per worker into a shell served at /pages/<name>.<hash>.html
+# with the same long lifetime, and /dashboard, /dailytrend and /history
+# check the login and redirect to the current shell.
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+@functools.lru_cache(maxsize=256)
+def static_fingerprint(filename):
+    path = safe_join(STATIC_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+@app.template_global()
+def static_url(filename):
+    fingerprint = static_fingerprint(filename)
+    return f"/static/{filename}?v={fingerprint}" if fingerprint else f"/static/{filename}"
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    versioned = "v" in request.args and request.args["v"] == static_fingerprint(filename)
+    response = send_from_directory(STATIC_DIR, filename, max_age=STATIC_MAX_AGE if versioned else 0)
+    if versioned:
+        response.cache_control.immutable = True
+    return response
+
+PAGE_SHELLS = {}
+
+def render_shell(source, **context):
+    body = app.jinja_env.from_string(source).render(**context).encode()
+    return hashlib.sha256(body).hexdigest()[:12], body
+
+def redirect_to_shell(name):
     if not session.get('logged_in'):
         return redirect('/')
-    html = """
+    fingerprint, _ = PAGE_SHELLS[name]
+    return redirect(f"/pages/{name}.{fingerprint}.html")
+
+@app.route('/pages/<name>.<fingerprint>.html')
+def page_shell(name, fingerprint):
+    if not session.get('logged_in'):
+        return redirect('/')
+    if name not in PAGE_SHELLS:
+        return jsonify({"error": "Not found"}), 404
+    current, body = PAGE_SHELLS[name]
+    if fingerprint != current:
+        # A link from before the last deploy.
+        return redirect(f"/{name}")
+    response = make_response(body)
+    response.mimetype = "text/html"
+    response.headers["Cache-Control"] = f"private, max-age={STATIC_MAX_AGE}, immutable"
+    return response
+
+@app.route('/stream')
+def stream():
+    if not session.get('logged_in'):
+        return jsonify({"error": "Unauthorized"}), 401
+    broadcaster = get_broadcaster()
+    q = broadcaster.subscribe()
+    if q is None:
+        response = jsonify({"error": "Too many live viewers"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+
+    def events():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    payload = q.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: update\ndata: {payload}\n\n"
+        finally:
+            broadcaster.unsubscribe(q)
+
+    return Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+DASHBOARD_PAGE = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -198,7 +2311,7 @@ def dashboard():
         <style>
             /* Background image on body */
             body {
-                background: url('/static/imgs/dashboard.jpg') no-repeat center center fixed;
+                background: url('{{ static_url("imgs/dashboard.jpg") }}') no-repeat center center fixed;
                 background-size: cover;
                 font-family: Arial, sans-serif;
                 margin: 20px;
@@ -295,21 +2408,32 @@ def dashboard():
             <p id="last-updated" style="font-style: italic; color: #555;"></p>
         </div>
         <script>
-            // Colors per size category for bars
-            const categoryColors = {
-                "<30mm": "#4CAF50",
-                "30-50mm": "#2196F3",
-                "50-80mm": "#FF9800",
-                "80-150mm": "#9C27B0",
-                ">150mm": "#F44336"
-            };
+            // Size bins in display order, and their bar colors
+            const sizeBins = {{ size_bins|tojson }};
+            const categoryColors = Object.fromEntries(sizeBins.map(b => [b.label, b.color]));
         
-            // Fetch data once and update UI
+            // Totals as last received, and the version to ask for changes since
+            let dashboardData = { totals: {}, last_updated: null };
+            let dataVersion = null;
+
+            // Fetch the cells changed since the last fetch (everything the
+            // first time) and update the UI if anything changed
             async function fetchDashboardData() {
                 try {
-                    const res = await fetch("/dashboard-data");
+                    const url = dataVersion === null ? "/dashboard-data" : `/dashboard-data?since=${dataVersion}`;
+                    const res = await fetch(url);
+                    if (res.status === 204) return;
                     const data = await res.json();
-                    updateDashboardUI(data);
+                    if (data.full) {
+                        dashboardData.totals = data.totals;
+                    } else {
+                        for (const [node, sizes] of Object.entries(data.totals)) {
+                            dashboardData.totals[node] = Object.assign(dashboardData.totals[node] || {}, sizes);
+                        }
+                    }
+                    dashboardData.last_updated = data.last_updated;
+                    dataVersion = data.version;
+                    updateDashboardUI(dashboardData);
                 } catch (error) {
                     console.error("Failed to load dashboard data", error);
                     document.getElementById("tables").innerHTML = "<p style='color: red;'>Error loading data.</p>";
@@ -327,7 +2451,7 @@ def dashboard():
                 tablesContainer.innerHTML = "";
         
                 const labels = Object.keys(totals);
-                const sizeCategories = ["<30mm", "30-50mm", "50-80mm", "80-150mm", ">150mm"];
+                const sizeCategories = sizeBins.map(b => b.label);
         
                 for (const node of labels) {
                     const nodeData = totals[node];
@@ -394,67 +2518,78 @@ def dashboard():
                 });
             }
         
-            // Polling function: fetch data every interval ms, then update UI
-            let previousDataJSON = null;  // store stringified data for comparison
-            
-            function isDataChanged(newData) {
-                const newDataJSON = JSON.stringify(newData);
-                if (newDataJSON === previousDataJSON) {
-                    return false; // no change
-                }
-                previousDataJSON = newDataJSON;
-                return true; // changed
-            }
-            
-            function updateDashboardUIIfChanged(data) {
-                if (isDataChanged(data)) {
-                    updateDashboardUI(data);
-                } else {
-                    console.log("No data change detected, skipping UI update.");
-                }
-            }
-            
-            // Then change your pollAndUpdate call to use updateDashboardUIIfChanged
-            
-            function pollAndUpdate(url, updateFn, intervalMs) {
-                async function poll() {
-                    try {
-                        const response = await fetch(url);
-                        const data = await response.json();
-                        updateFn(data);
-                    } catch (error) {
-                        console.error("Polling error:", error);
-                    }
-                    setTimeout(poll, intervalMs);
+            // Refetch when the server pushes an update over /stream (coalesced
+            // to at most one fetch per second), and after a reconnect in case
+            // updates were missed while disconnected.
+            function subscribeToUpdates(refreshFn) {
+                let pending = null;
+                let connected = false;
+                function refresh() {
+                    if (pending) return;
+                    pending = setTimeout(() => {
+                        pending = null;
+                        refreshFn();
+                    }, 1000);
                 }
-                poll();
+                const source = new EventSource("/stream");
+                source.addEventListener("update", refresh);
+                source.addEventListener("open", () => {
+                    if (connected) refresh();
+                    connected = true;
+                });
             }
              
             window.onload = () => {
                 fetchDashboardData();  // initial load
-                pollAndUpdate("/dashboard-data", updateDashboardUIIfChanged, 15000);
+                subscribeToUpdates(fetchDashboardData);
             };
         </script>
     </body>
     </html>
     """
-    return render_template_string(html)
+PAGE_SHELLS["dashboard"] = render_shell(DASHBOARD_PAGE, size_bins=SIZE_BINS)
+
+@app.route('/dashboard')
+def dashboard():
+    return redirect_to_shell("dashboard")
 
 
+# Without ?since= returns every node_totals cell. With ?since=<version> (the
+# "version" of an earlier response) returns only the cells changed after it,
+# or 204 if there are none; "full" tells the client to replace rather than
+# merge, e.g. after a reset. Versions are transaction ids: every transaction
+# older than the returned version had finished when it was taken, so cells
+# changed later carry a changed_xid at or above it.
 @app.route('/dashboard-data')
+@conditional_on_data_version()
 def dashboard_data():
-    with get_db_conn() as conn:
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            since = None
+        # xid8 is unsigned 64-bit; anything outside would fail the query.
+        if since is None or not 0 <= since < 2**64:
+            return jsonify({"error": "since must be a version returned by /dashboard-data"}), 400
+
+    with get_db_conn(DB_READ_TIMEOUT_MS) as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT node, size_range, SUM(count) FROM realdata GROUP BY node, size_range")
+            cursor.execute("""
+                SELECT pg_snapshot_xmin(pg_current_snapshot())::text,
+                       (SELECT value FROM meta WHERE key = 'totals_reset_xid')
+            """)
+            version, reset_xid = cursor.fetchone()
+            full = since is None or (reset_xid is not None and since <= int(reset_xid))
+            if full:
+                cursor.execute("SELECT node, size_range, total FROM node_totals")
+            else:
+                cursor.execute("SELECT node, size_range, total FROM node_totals WHERE changed_xid >= %s::xid8",
+                               (str(since),))
             rows = cursor.fetchall()
 
-            cursor.execute("SELECT value FROM meta WHERE key='last_update'")
-            row = cursor.fetchone()
-            if row:
-                dt = parser.isoparse(row[0])  # handles ISO8601 including Z and fractions
-                last_updated = dt.isoformat()
-            else:
-                last_updated = None
+    if not full and not rows:
+        return "", 204
 
     totals = {}
     for node, size, count in rows:
@@ -462,9 +2597,12 @@ def dashboard_data():
             totals[node] = {}
         totals[node][size] = count
 
+    last_update = data_last_update()
     return jsonify({
         "totals": totals,
-        "last_updated": last_updated
+        "last_updated": last_update.isoformat() if last_update else None,
+        "version": version,
+        "full": full
     })
 
 @app.route('/reset', methods=['POST'])
@@ -474,19 +2612,32 @@ def reset():
     if request.headers.get("Authorization", "") != f"Bearer {RESET_KEY}":
         return jsonify({"error": "Unauthorized"}), 401
 
+    # Work proportional to the number of nodes, not the data: raw rows and
+    # older rollups are only hidden here (see reset_cutoff) and expired later
+    # by the maintenance job.
     with get_db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM realdata")
-            cur.execute("DELETE FROM meta WHERE key = 'last_update'")
+            # Waits for ingests in flight and holds off new ones until commit,
+            # so every reading is either archived or counted.
+            cur.execute("LOCK TABLE node_totals IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute('''
+                INSERT INTO meta (key, value) VALUES ('reset_at', clock_timestamp()::text)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                RETURNING value::timestamptz
+            ''')
+            reset_at = cur.fetchone()[0]
+            cur.execute("DELETE FROM node_totals")
+            cur.execute("DELETE FROM realdata_minute WHERE minute >= %s", (reset_floor("realdata_minute", reset_at),))
+            cur.execute("DELETE FROM realdata_daily WHERE day >= %s", (reset_floor("realdata_daily", reset_at).date(),))
+            cur.execute("UPDATE nodes SET last_seen = NULL WHERE last_seen IS NOT NULL")
+            cur.execute("DELETE FROM meta WHERE key = 'raw_horizon'")
+            mark_totals_reset(cur)
             conn.commit()
+        publish_data_change(conn, reset=True, reset_at=reset_at.isoformat())
 
     return jsonify({"message": "Dashboard data reset."})
 
-@app.route('/dailytrend')
-def dailytrend():
-    if not session.get('logged_in'):
-        return redirect('/')
-    html = """
+DAILYTREND_PAGE = """
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -498,7 +2649,7 @@ def dailytrend():
           font-family: Arial, sans-serif;
           padding: 0;
           margin: 0;
-          background: url('/static/imgs/dailytrend.jpg') no-repeat center center fixed;
+          background: url('{{ static_url("imgs/dailytrend.jpg") }}') no-repeat center center fixed;
           background-size: cover;
           display: flex;
           justify-content: center;
@@ -573,21 +2724,29 @@ def dailytrend():
 
         <script>
           let dailyChartInstance = null;
-          let previousTrendDataJSON = null;
         
-          // Fetch trend data from API
+          // Fetch trend data from API in the compact encoding and expand it
+          // to timestamps and percentages. The browser revalidates its cached
+          // copy with the ETag, so an unchanged trend comes back as a 304.
           async function fetchTrendData() {
-            const res = await fetch('/api/daily-trend');
-            return await res.json();
+            const res = await fetch('/api/daily-trend?points=480&format=compact');
+            const data = await res.json();
+            const start = Date.parse(data.start);
+            const count = data.datasets.length ? data.datasets[0].values.length : 0;
+            const offsets = data.offsets || Array.from({ length: count }, (_, i) => i);
+            data.timestamps = offsets.map(offset => start + offset * data.step * 1000);
+            data.datasets.forEach(ds => { ds.values = ds.values.map(bp => bp / 100); });
+            data.etag = res.headers.get('ETag');
+            return data;
           }
         
           // Check if data changed
-          let previousDataHash = null;
+          let previousETag = null;
           function isDataChanged(newData) {
-            if (!newData.data_hash || newData.data_hash === previousDataHash) {
+            if (!newData.etag || newData.etag === previousETag) {
               return false;
             }
-            previousDataHash = newData.data_hash;
+            previousETag = newData.etag;
             return true;
           }
         
@@ -652,121 +2811,179 @@ def dailytrend():
             }
           }
         
-          // Polling function
-          function pollAndUpdate(url, updateFn, intervalMs) {
-            async function poll() {
-              try {
-                const res = await fetch(url);
-                const data = await res.json();
-                updateFn(data);
-              } catch (err) {
-                console.error("Polling error:", err);
-              }
-              setTimeout(poll, intervalMs);
+          // Refetch when the server pushes an update over /stream (coalesced
+          // to at most one fetch per second), and after a reconnect.
+          function subscribeToUpdates(fetchFn, updateFn) {
+            let pending = null;
+            let connected = false;
+            function refresh() {
+              if (pending) return;
+              pending = setTimeout(async () => {
+                pending = null;
+                try {
+                  updateFn(await fetchFn());
+                } catch (err) {
+                  console.error("Refresh error:", err);
+                }
+              }, 1000);
             }
-            poll();
+            const source = new EventSource('/stream');
+            source.addEventListener('update', refresh);
+            source.addEventListener('open', () => {
+              if (connected) refresh();
+              connected = true;
+            });
           }
         
-          // Initial load + polling setup
+          // Initial load + live updates
           window.onload = () => {
             fetchTrendData().then(data => updateTrendUIIfChanged(data));
-            pollAndUpdate('/api/daily-trend', updateTrendUIIfChanged, 15000);
+            subscribeToUpdates(fetchTrendData, updateTrendUIIfChanged);
         };
         </script>
     </body>
     </html>
     """
-    return render_template_string(html)
+PAGE_SHELLS["dailytrend"] = render_shell(DAILYTREND_PAGE)
 
+@app.route('/dailytrend')
+def dailytrend():
+    return redirect_to_shell("dailytrend")
+
+# Bucket sizes accepted by /api/daily-trend?bucket=, in minutes.
+TREND_BUCKETS = {"1m": 1, "5m": 5, "10m": 10, "15m": 15, "30m": 30, "1h": 60}
+
+# Per-bucket share of each category, in percent. rows are (bucket,
+# size_range, total) ordered by bucket; each cell is visited once and each
+# bucket total is computed once.
+def trend_percentages(rows, categories):
+    index = {cat: i for i, cat in enumerate(categories)}
+    times = []
+    counts = [[] for _ in categories]
+    last = None
+    for bucket, size_range, total in rows:
+        if bucket != last:
+            times.append(bucket)
+            for column in counts:
+                column.append(0)
+            last = bucket
+        i = index.get(size_range)
+        if i is not None:
+            counts[i][-1] += total
+    totals = [sum(cells) for cells in zip(*counts)]
+    percents = [[round(count / total * 100, 2) if total else 0 for count, total in zip(column, totals)]
+                for column in counts]
+    return times, percents
+
+# Largest-Triangle-Three-Buckets downsampling of several series sharing one
+# x axis: keeps the first and last point and, from each of threshold - 2
+# buckets, the point forming the largest triangles (summed over all series)
+# with the previously kept point and the next bucket's average. Returns the
+# indices to keep.
+def lttb_indices(xs, series, threshold):
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    kept = [0]
+    a = 0
+    for b in range(threshold - 2):
+        start = int(b * every) + 1
+        end = int((b + 1) * every) + 1
+        next_end = min(int((b + 2) * every) + 1, n)
+        span = next_end - end
+        avg_x = sum(xs[end:next_end]) / span
+        avg_ys = [sum(ys[end:next_end]) / span for ys in series]
+        best, best_area = start, -1
+        for j in range(start, end):
+            dx_a = xs[a] - avg_x
+            dx_j = xs[a] - xs[j]
+            area = 0
+            for ys, avg_y in zip(series, avg_ys):
+                area += abs(dx_a * (ys[j] - ys[a]) - dx_j * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        kept.append(best)
+        a = best
+    kept.append(n - 1)
+    return kept
+
+# The /api/daily-trend body. By default every point has its ISO timestamp and
+# the shares are percentages with two decimals. The compact encoding
+# (?format=compact) sends the first bucket and the bucket length in seconds
+# instead, plus each point's offset from the first in buckets ("offsets",
+# left out when no bucket is missing), and the shares as integer basis
+# points (hundredths of a percent, the same precision).
+def trend_payload(times, percents, bucket, end_time, compact=False):
+    if compact:
+        step = TREND_BUCKETS[bucket] * 60
+        payload = {"start": times[0].astimezone(timezone.utc).isoformat() if times else None, "step": step}
+        offsets = [int((t - times[0]).total_seconds()) // step for t in times]
+        if offsets and offsets[-1] != len(offsets) - 1:
+            payload["offsets"] = offsets
+        percents = [[round(value * 100) for value in values] for values in percents]
+    else:
+        payload = {"timestamps": [t.astimezone(timezone.utc).isoformat() for t in times]}
+    payload.update({
+        "datasets": [
+            {"label": b["label"], "values": values, "color": b["color"]}
+            for b, values in zip(SIZE_BINS, percents)
+        ],
+        "bucket": bucket,
+        "last_updated": end_time.isoformat()
+    })
+    return payload
+
+# ?bucket= aggregates minutes before computing percentages; ?points= then
+# thins the series to at most that many points with LTTB.
 @app.route('/api/daily-trend')
+@conditional_on_data_version()
 def api_daily_trend():
-    
-    with get_db_conn() as conn:
+    bucket = request.args.get("bucket", "1m")
+    if bucket not in TREND_BUCKETS:
+        return jsonify({"error": f"bucket must be one of {', '.join(TREND_BUCKETS)}"}), 400
+    points = request.args.get("points")
+    if points is not None:
+        try:
+            points = int(points)
+        except ValueError:
+            points = 0
+        if points < 3:
+            return jsonify({"error": "points must be an integer of at least 3"}), 400
+    fmt = request.args.get("format", "json")
+    if fmt not in ("json", "compact"):
+        return jsonify({"error": "format must be json or compact"}), 400
+
+    _, last_update, reset_at = data_state()
+    end_time = last_update or datetime.now(timezone.utc)
+    start_time = end_time - timedelta(hours=24)
+    reset_from = reset_floor("realdata_minute", reset_at)
+    if reset_from is not None and reset_from > start_time:
+        start_time = reset_from
+    with get_db_conn(DB_READ_TIMEOUT_MS) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT value FROM meta WHERE key='last_update'")
-        row = cursor.fetchone()
-        if row:
-            dt = parser.isoparse(row[0])
-            end_time = dt
-        else:
-            end_time = datetime.now(timezone.utc)
-    
-        start_time = end_time - timedelta(hours=24)
-
-    categories = ['<30mm', '30-50mm', '50-80mm', '80-150mm', '>150mm']
-    color_map = {
-        '<30mm': '#1f77b4',
-        '30-50mm': '#ff7f0e',
-        '50-80mm': '#2ca02c',
-        '80-150mm': '#d62728',
-        '>150mm': '#9467bd',
-    }
 
-    with get_db_conn() as conn:
-        cursor = conn.cursor()
+        # At most 1440 minutes x 5 sizes, whatever the raw volume.
         cursor.execute(""" 
-            SELECT 
-                DATE_TRUNC('minute', timestamp AT TIME ZONE 'UTC') AS minute,
-                size_range,
-                SUM(count) AS total
-            FROM realdata
-            WHERE timestamp >= %s AND timestamp < %s
-            GROUP BY minute, size_range
-            ORDER BY minute;
-        """, (start_time, end_time))
+            SELECT date_bin(%s, minute, TIMESTAMPTZ 'epoch') AS bucket, size_range, SUM(total)::bigint AS total
+            FROM realdata_minute
+            WHERE minute >= DATE_TRUNC('minute', %s AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AND minute <= %s
+            GROUP BY bucket, size_range
+            ORDER BY bucket;
+        """, (timedelta(minutes=TREND_BUCKETS[bucket]), start_time, end_time))
         rows = cursor.fetchall()
 
-    minute_bins = {}
-    for minute, size_range, total in rows:
-        key = minute.replace(tzinfo=timezone.utc).isoformat()
-        if key not in minute_bins:
-            minute_bins[key] = defaultdict(int)
-        minute_bins[key][size_range] += total
-
-    sorted_times = sorted(minute_bins.keys())
-
-    datasets = []
-    for cat in categories:
-        values = []
-        for t in sorted_times:
-            total_count = sum(minute_bins[t].values())
-            percent = (minute_bins[t][cat] / total_count * 100) if total_count else 0
-            values.append(round(percent, 2))
-        datasets.append({
-            "label": cat,
-            "values": values,
-            "color": color_map.get(cat, "#000000")
-        })
-
-    data_payload = {
-        "timestamps": sorted_times,
-        "datasets": datasets
-    }
-
-    data_hash = hashlib.md5(json.dumps(data_payload, sort_keys=True).encode()).hexdigest()
+    times, percents = trend_percentages(rows, SIZE_LABELS)
+    if points is not None and points < len(times):
+        kept = lttb_indices([t.timestamp() for t in times], percents, points)
+        times = [times[i] for i in kept]
+        percents = [[values[i] for i in kept] for values in percents]
 
-    if not hasattr(current_app, 'last_trend_hash'):
-        current_app.last_trend_hash = None
-        current_app.last_trend_updated = end_time.isoformat()
-
-    # Only update timestamp if data hash changed
-    if data_hash != current_app.last_trend_hash:
-        current_app.last_trend_hash = data_hash
-        current_app.last_trend_updated = end_time.isoformat()
-
-    return jsonify({
-        **data_payload,
-        "last_updated": current_app.last_trend_updated,
-        "data_hash": data_hash
-    })
+    return jsonify(trend_payload(times, percents, bucket, end_time, compact=fmt == "compact"))
 
 
 # --- Add this route to serve the history chart page ---
-@app.route('/history')
-def history():
-    if not session.get('logged_in'):
-        return redirect('/')
-    html = """
+HISTORY_PAGE = """
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -778,7 +2995,7 @@ def history():
           font-family: Arial, sans-serif;
           padding: 0;
           margin: 0;
-          background: url('/static/imgs/history.jpg') no-repeat center center fixed;
+          background: url('{{ static_url("imgs/history.jpg") }}') no-repeat center center fixed;
           background-size: cover;
           display: flex;
           justify-content: center;
@@ -847,30 +3064,29 @@ def history():
           return await res.json();
         }
 
+        let historyChartInstance = null;
+        const classColors = ['75, 192, 192', '255, 99, 132', '255, 159, 64', '153, 102, 255'];
+
         function renderChart(data) {
           const ctx = document.getElementById('historyChart').getContext('2d');
-          new Chart(ctx, {
+          if (historyChartInstance) {
+            historyChartInstance.destroy();
+          }
+          historyChartInstance = new Chart(ctx, {
             type: 'line',
             data: {
               labels: data.dates,
-              datasets: [
-                {
-                  label: 'Small (<= 50mm) %',
-                  data: data.small,
-                  borderColor: 'rgba(75, 192, 192, 1)',
-                  backgroundColor: 'rgba(75, 192, 192, 0.2)',
-                  fill: false,
-                  tension: 0.2
-                },
-                {
-                  label: 'Large (> 50mm) %',
-                  data: data.large,
-                  borderColor: 'rgba(255, 99, 132, 1)',
-                  backgroundColor: 'rgba(255, 99, 132, 0.2)',
+              datasets: Object.entries(data.classes).map(([name, range], i) => {
+                const color = classColors[i % classColors.length];
+                return {
+                  label: `${name[0].toUpperCase()}${name.slice(1)} (${range}) %`,
+                  data: data[name],
+                  borderColor: `rgba(${color}, 1)`,
+                  backgroundColor: `rgba(${color}, 0.2)`,
                   fill: false,
                   tension: 0.2
-                }
-              ]
+                };
+              })
             },
             options: {
               responsive: true,
@@ -895,108 +3111,409 @@ def history():
           });
         }
 
+        // Refetch when the server pushes an update over /stream (coalesced
+        // to at most one fetch per second), and after a reconnect.
+        function subscribeToUpdates(onUpdate) {
+          let pending = null;
+          let connected = false;
+          function refresh() {
+            if (pending) return;
+            pending = setTimeout(() => {
+              pending = null;
+              onUpdate().catch(err => console.error("Refresh error:", err));
+            }, 1000);
+          }
+          const source = new EventSource('/stream');
+          source.addEventListener('update', refresh);
+          source.addEventListener('open', () => {
+            if (connected) refresh();
+            connected = true;
+          });
+        }
+
         fetchHistory().then(renderChart);
+        subscribeToUpdates(() => fetchHistory().then(renderChart));
       </script>
     </body>
     </html>
     """
-    return render_template_string(html)
+PAGE_SHELLS["history"] = render_shell(HISTORY_PAGE)
+
+@app.route('/history')
+def history():
+    return redirect_to_shell("history")
 
 # --- Add this API endpoint to return JSON data for the past 7 days ---
 @app.route('/api/history')
+@conditional_on_data_version(lambda: datetime.now(tz=EGYPT_TZ).date().isoformat())
 def api_history():
     today = datetime.now(tz=EGYPT_TZ).date()
     seven_days_ago = today - timedelta(days=6)  # including today = 7 days
+    reset_from = reset_floor("realdata_daily", data_reset_at())
+    first_day = max(seven_days_ago, reset_from.date()) if reset_from else seven_days_ago
 
-    with get_db_conn() as conn:
+    with get_db_conn(DB_READ_TIMEOUT_MS) as conn:
         with conn.cursor() as cur:
-            # Existing aggregation query
+            # Days are Cairo-local dates, so this is a plain range scan on
+            # the rollup's primary key; size_bins maps each bin to its class
+            # and the window function turns class totals into shares of the day.
             cur.execute("""
-                SELECT
-                    DATE(timestamp AT TIME ZONE 'Africa/Cairo') as day,
-                    size_range,
-                    SUM(count) as total_count
-                FROM realdata
-                WHERE DATE(timestamp AT TIME ZONE 'Africa/Cairo') >= %s
-                GROUP BY day, size_range
-                ORDER BY day;
-            """, (seven_days_ago,))
+                SELECT d.day, b.size_class,
+                       ROUND(SUM(d.total) * 100.0 / NULLIF(SUM(SUM(d.total)) OVER (PARTITION BY d.day), 0), 2)::float
+                FROM realdata_daily d
+                JOIN size_bins b ON b.label = d.size_range
+                WHERE d.day >= %s AND d.day <= %s
+                GROUP BY d.day, b.size_class
+            """, (first_day, today))
             rows = cur.fetchall()
-           
-            # New: fetch last_updated from meta or max timestamp
-            cur.execute("SELECT value FROM meta WHERE key='last_update'")
-            row = cur.fetchone()
-            if row:
-                last_updated = row[0]
-            else:
-                cur.execute("SELECT MAX(timestamp) FROM realdata")
-                max_row = cur.fetchone()
-                last_updated = max_row[0].isoformat() if max_row and max_row[0] else None
-
-            
-    # Initialize a dict to hold counts per day
-    day_data = {}
-    for i in range(7):
-        day = seven_days_ago + timedelta(days=i)
-        day_data[day] = {"small": 0, "large": 0}
-
-    # Aggregate counts
-    for day, size_range, total_count in rows:
-        # Determine small or large
-        # Assume size_range string contains a number, e.g. "30-50mm", "80-150mm"
-        # Extract lower bound or midpoint for classification
-        size_range_clean = size_range.lower().replace(" ", "")
-
-        # Extract all numbers from the string, as a list of ints
-        numbers = [int(num) for num in re.findall(r'\d+', size_range_clean)]
-
-        classification = "large"  # default
-
-        if numbers:
-            # For '>30mm', numbers = [30]
-            # For '30-50mm', numbers = [30, 50]
-            # Logic: if the upper bound or the average is <= 50, classify as small
-
-            # If only one number, like >30, check if it's <= 50
-            if len(numbers) == 1:
-                if numbers[0] <= 50:
-                    classification = "small"
+
+    last_update = data_last_update()
+    days = [seven_days_ago + timedelta(days=i) for i in range(7)]
+    percents = {name: [0] * 7 for name in SIZE_CLASS_RANGES}
+    for day, size_class, percent in rows:
+        index = (day - seven_days_ago).days
+        if size_class in percents and 0 <= index < 7:
+            percents[size_class][index] = percent or 0
+
+    return jsonify({
+        "dates": [day.strftime("%d/%m/%y") for day in days],
+        **percents,
+        "classes": SIZE_CLASS_RANGES,
+        "last_updated": last_update.isoformat() if last_update else None
+    })
+
+
+# Generic time series: /api/series?from=&to=&bucket=&node=&tz=. Counts per
+# size for each bucket in [from, to), read from the cheapest table that has
+# the resolution: realdata_daily for whole-day buckets in Cairo time,
+# realdata for sub-minute buckets, realdata_minute otherwise. Buckets are
+# aligned to wall-clock time in tz; weeks start on Monday.
+SERIES_MAX_POINTS = int(os.getenv("SERIES_MAX_POINTS", "2000"))
+SERIES_BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+# date_bin() overflows on strides of a few hundred thousand years; a century
+# is one bucket for anything stored here anyway.
+SERIES_MAX_BUCKET = timedelta(days=36525)
+# Far enough inside datetime's range that the default one-day window and
+# time zone shifts cannot overflow.
+SERIES_TIME_RANGE = (datetime(2, 1, 1, tzinfo=timezone.utc), datetime(9998, 12, 31, tzinfo=timezone.utc))
+
+def parse_series_bucket(value):
+    match = re.fullmatch(r"(\d+)([smhdw])", value)
+    if not match or int(match.group(1)) == 0:
+        raise ValueError("bucket must look like 30s, 5m, 1h, 1d or 1w")
+    try:
+        bucket = timedelta(seconds=int(match.group(1)) * SERIES_BUCKET_UNITS[match.group(2)])
+    except OverflowError:
+        bucket = None
+    if bucket is None or bucket > SERIES_MAX_BUCKET:
+        raise ValueError(f"bucket must be at most {SERIES_MAX_BUCKET.days}d")
+    return bucket
+
+def parse_series_time(value, tz, name):
+    try:
+        dt = parser.isoparse(value)
+    except (ValueError, OverflowError):
+        raise ValueError(f"{name} must be an ISO-8601 time")
+    try:
+        dt = tz.localize(dt) if dt.tzinfo is None else dt
+    except OverflowError:
+        dt = None
+    if dt is None or not SERIES_TIME_RANGE[0] <= dt <= SERIES_TIME_RANGE[1]:
+        raise ValueError(f"{name} must be between the years 2 and 9998")
+    return dt
+
+@app.route('/api/series')
+@conditional_on_data_version()
+def api_series():
+    try:
+        tz = pytz.timezone(request.args.get("tz", EGYPT_TZ.zone))
+    except pytz.UnknownTimeZoneError:
+        return jsonify({"error": "Unknown tz"}), 400
+    try:
+        bucket = parse_series_bucket(request.args.get("bucket", "1h"))
+        start = parse_series_time(request.args["from"], tz, "from") if "from" in request.args else None
+        end = parse_series_time(request.args["to"], tz, "to") if "to" in request.args else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    node = request.args.get("node")
+
+    whole_days = bucket % timedelta(days=1) == timedelta(0)
+    if whole_days and tz.zone == EGYPT_TZ.zone:
+        source = "realdata_daily"
+    elif bucket < timedelta(minutes=1):
+        source = "realdata"
+    else:
+        source = "realdata_minute"
+
+    _, last_update, reset_at = data_state()
+    with get_db_conn(DB_READ_TIMEOUT_MS) as conn:
+        with conn.cursor() as cur:
+            # Without `to` the series ends at the newest reading, so the
+            # response only changes when the data version does.
+            if end is None:
+                end = last_update or datetime.now(timezone.utc)
+            if start is None:
+                start = end - timedelta(days=1)
+            if start >= end:
+                return jsonify({"error": "from must be before to"}), 400
+            points = math.ceil((end - start) / bucket)
+            if points > SERIES_MAX_POINTS:
+                return jsonify({"error": f"{points} buckets requested; at most {SERIES_MAX_POINTS}, use a larger bucket"}), 400
+
+            if source == "realdata":
+                horizon, _, _ = raw_horizon(cur)
+                if horizon is not None and start < horizon:
+                    return jsonify({"error": f"Raw readings before {horizon.isoformat()} have expired; use a bucket of 1m or more"}), 400
+            elif source == "realdata_minute" and MINUTE_RETENTION_DAYS:
+                cutoff = retention_cutoff(datetime.now(timezone.utc), MINUTE_RETENTION_DAYS)
+                if start < cutoff:
+                    return jsonify({"error": f"Per-minute data before {cutoff.isoformat()} has expired; "
+                                             f"use whole-day buckets with tz={EGYPT_TZ.zone}"}), 400
+
+            # Nothing from before the last /reset is shown; starting the scan
+            # there also skips archived partitions at plan time.
+            query_start = start
+            reset_from = reset_floor(source, reset_at)
+            if reset_from is not None and reset_from > start:
+                query_start = reset_from
+
+            node_filter = sql.SQL("AND node = %(node)s") if node is not None else sql.SQL("")
+            if source == "realdata_daily":
+                local_start = query_start.astimezone(EGYPT_TZ)
+                local_end = end.astimezone(EGYPT_TZ)
+                end_day = local_end.date() + timedelta(days=1 if local_end.time() != datetime.min.time() else 0)
+                query = sql.SQL("""
+                    SELECT date_bin(%(bucket)s, day::timestamp, TIMESTAMP '2000-01-03') AT TIME ZONE %(tz)s AS bucket,
+                           size_range, SUM(total)::bigint
+                    FROM realdata_daily
+                    WHERE day >= %(start_day)s AND day < %(end_day)s {node_filter}
+                    GROUP BY 1, size_range
+                    ORDER BY 1
+                """).format(node_filter=node_filter)
+                params = {"start_day": local_start.date(), "end_day": end_day}
             else:
-                # multiple numbers (e.g., 30 and 50), take average
-                avg = sum(numbers) / len(numbers)
-                if avg <= 50:
-                    classification = "small"
-
-        if day in day_data:
-            day_data[day][classification] += total_count
-
-    # Prepare data for JSON response
-    dates = []
-    small_percents = []
-    large_percents = []
-
-    for day in sorted(day_data.keys()):
-        small_count = day_data[day]["small"]
-        large_count = day_data[day]["large"]
-        total = small_count + large_count
-        if total > 0:
-            small_pct = round((small_count / total) * 100, 2)
-            large_pct = round((large_count / total) * 100, 2)
-        else:
-            small_pct = 0
-            large_pct = 0
-        dates.append(day.strftime("%d/%m/%y"))
-        small_percents.append(small_pct)
-        large_percents.append(large_pct)
+                time_column, count_column = ("timestamp", "count") if source == "realdata" else ("minute", "total")
+                query = sql.SQL("""
+                    SELECT date_bin(%(bucket)s, {time} AT TIME ZONE %(tz)s, TIMESTAMP '2000-01-03') AT TIME ZONE %(tz)s AS bucket,
+                           size_range, SUM({count})::bigint
+                    FROM {table}
+                    WHERE {time} >= %(start)s AND {time} < %(end)s AND size_range IS NOT NULL {node_filter}
+                    GROUP BY 1, size_range
+                    ORDER BY 1
+                """).format(time=sql.Identifier(time_column), count=sql.Identifier(count_column),
+                            table=sql.Identifier(source), node_filter=node_filter)
+                params = {"start": query_start, "end": end}
+            cur.execute(query, {**params, "bucket": bucket, "tz": tz.zone, "node": node})
+            rows = cur.fetchall()
+
+    timestamps = []
+    series = {size: [] for size in SIZE_LABELS}
+    for bucket_start, size_range, total in rows:
+        if not timestamps or timestamps[-1] != bucket_start:
+            timestamps.append(bucket_start)
+            for values in series.values():
+                values.append(0)
+        if size_range in series:
+            series[size_range][-1] += total
 
     return jsonify({
-        "dates": dates,
-        "small": small_percents,
-        "large": large_percents,
-        "last_updated": last_updated
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "bucket": request.args.get("bucket", "1h"),
+        "tz": tz.zone,
+        "node": node,
+        "source": source,
+        "timestamps": [t.astimezone(tz).isoformat() for t in timestamps],
+        "series": series
+    })
+
+
+# Exports (/export). Rows are read through a named (server-side) cursor in
+# EXPORT_FETCH_ROWS batches and streamed out as they arrive, so memory stays
+# flat however long the range is. Plain reads take no locks that would block
+# ingestion. Rollups come out in key order; raw rows in storage order, which
+# is roughly chronological.
+#
+# A download can last as long as the uplink makes it, so each export reads
+# on a connection of its own rather than a pooled one, and at most
+# EXPORT_MAX_CONCURRENT run per worker; /update never waits for them. A
+# client that stops reading for EXPORT_IDLE_TIMEOUT_MS loses its export.
+EXPORT_FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "10000"))
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "2"))
+EXPORT_IDLE_TIMEOUT_MS = int(os.getenv("EXPORT_IDLE_TIMEOUT_MS", "60000"))
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+EXPORT_SOURCES = {
+    "raw": ("realdata", "timestamp", ["node", "status", "timestamp", "size_range", "count"]),
+    "minute": ("realdata_minute", "minute", ["minute", "node", "size_range", "total"]),
+    "daily": ("realdata_daily", "day", ["day", "node", "size_range", "total"]),
+}
+
+def export_batches(source, start, end, node, batch_rows=EXPORT_FETCH_ROWS):
+    table, time_column, columns = EXPORT_SOURCES[source]
+    reset_from = reset_floor(table, data_reset_at())
+    if reset_from is not None and (start is None or reset_from > start):
+        start = reset_from
+    conditions = []
+    if source == "daily":
+        # Rollup days are Cairo dates.
+        start = start and start.astimezone(EGYPT_TZ).date()
+        end = end and end.astimezone(EGYPT_TZ).date()
+    if start is not None:
+        conditions.append(sql.SQL("{} >= %(start)s").format(sql.Identifier(time_column)))
+    if end is not None:
+        conditions.append(sql.SQL("{} < %(end)s").format(sql.Identifier(time_column)))
+    if node is not None:
+        conditions.append(sql.SQL("node = %(node)s"))
+    query = sql.SQL("SELECT {columns} FROM {table}{where}{order}").format(
+        columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+        table=sql.Identifier(table),
+        where=sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL(""),
+        order=sql.SQL("") if source == "raw" else sql.SQL(" ORDER BY {}, node, size_range").format(sql.Identifier(time_column)),
+    )
+    connect_kwargs = get_pool().connect_kwargs
+    conn = psycopg2.connect(**dict(connect_kwargs, options=connect_kwargs["options"]
+                                   + f" -c idle_in_transaction_session_timeout={EXPORT_IDLE_TIMEOUT_MS}"))
+    try:
+        with conn.cursor(name="export") as cur:
+            cur.execute(query, {"start": start, "end": end, "node": node})
+            while True:
+                rows = cur.fetchmany(batch_rows)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        # Also reached when the client goes away mid-download.
+        conn.close()
+
+def csv_chunks(columns, batches):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+# Columnar exports: node, status and size_range are dictionary-encoded,
+# times are typed. Each fetched batch becomes one Parquet row group or one
+# Arrow IPC record batch, and is sent as soon as it is written.
+EXPORT_ROW_GROUP_ROWS = int(os.getenv("EXPORT_ROW_GROUP_ROWS", "65536"))
+
+def export_schema(source):
+    label = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    utc = pyarrow.timestamp("us", tz="UTC")
+    return pyarrow.schema({
+        "raw": [("node", label), ("status", label), ("timestamp", utc), ("size_range", label), ("count", pyarrow.int32())],
+        "minute": [("minute", utc), ("node", label), ("size_range", label), ("total", pyarrow.int64())],
+        "daily": [("day", pyarrow.date32()), ("node", label), ("size_range", label), ("total", pyarrow.int64())],
+    }[source])
+
+# Write-only file that hands out what has been written so far.
+class ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def columnar_chunks(schema, batches, fmt):
+    sink = ChunkSink()
+    if fmt == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+    for rows in batches:
+        columns = []
+        for values, field in zip(zip(*rows), schema):
+            if pyarrow.types.is_dictionary(field.type):
+                columns.append(pyarrow.array(values, type=field.type.value_type).dictionary_encode())
+            else:
+                columns.append(pyarrow.array(values, type=field.type))
+        writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+# /export?source=raw|minute|daily&from=&to=&node=&tz= downloads CSV (gzip=1
+# to compress it), or Parquet / Arrow IPC stream with format=parquet|arrow.
+# Needs a dashboard login or the Bearer API key.
+@app.route('/export')
+def export():
+    if not session.get('logged_in') and request.headers.get("Authorization", "") != f"Bearer {API_KEY}":
+        return jsonify({"error": "Unauthorized"}), 401
+    source = request.args.get("source", "raw")
+    if source not in EXPORT_SOURCES:
+        return jsonify({"error": f"source must be one of {', '.join(EXPORT_SOURCES)}"}), 400
+    try:
+        tz = pytz.timezone(request.args.get("tz", EGYPT_TZ.zone))
+    except pytz.UnknownTimeZoneError:
+        return jsonify({"error": "Unknown tz"}), 400
+    try:
+        start = parse_series_time(request.args["from"], tz, "from") if "from" in request.args else None
+        end = parse_series_time(request.args["to"], tz, "to") if "to" in request.args else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "parquet", "arrow"):
+        return jsonify({"error": "format must be one of csv, parquet, arrow"}), 400
+    if fmt != "csv" and pyarrow is None:
+        return jsonify({"error": "Columnar export needs pyarrow installed"}), 501
+
+    if not _export_slots.acquire(blocking=False):
+        response = jsonify({"error": "Too many exports running"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+    try:
+        response = export_response(source, start, end, request.args.get("node"), fmt)
+    except Exception:
+        _export_slots.release()
+        raise
+    # Runs once the download has finished or the client has gone away.
+    response.call_on_close(_export_slots.release)
+    return response
+
+def export_response(source, start, end, node, fmt):
+    filename = EXPORT_SOURCES[source][0]
+    if fmt != "csv":
+        batches = export_batches(source, start, end, node, EXPORT_ROW_GROUP_ROWS)
+        chunks = columnar_chunks(export_schema(source), batches, fmt)
+        filename += ".parquet" if fmt == "parquet" else ".arrows"
+        mimetype = "application/vnd.apache.parquet" if fmt == "parquet" else "application/vnd.apache.arrow.stream"
+    else:
+        chunks = csv_chunks(EXPORT_SOURCES[source][2], export_batches(source, start, end, node))
+        filename += ".csv"
+        mimetype = "text/csv"
+    if fmt == "csv" and request.args.get("gzip") in ("1", "true"):
+        chunks = gzip_chunks(chunks)
+        filename += ".gz"
+        mimetype = "application/gzip"
+    return Response(chunks, mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "X-Accel-Buffering": "no",
     })
 
 
 if __name__ == '__main__':
-    init_db()
+    get_pool()  # creates the pool, which ensures the schema
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,311 @@
+"""Benchmarks for the dashboard backend.
+
+They write to the database in DATABASE_URL, so point it at a scratch
+database, e.g.:
+
+    DATABASE_URL=postgresql://postgres@localhost/rock_bench python bench.py ingest
+
+`trend` is a CPU-only microbenchmark of the /api/daily-trend shaping over
+synthetic 24h and 7d minute data and needs no database; neither do
+`payload`, which compares the /api/daily-trend encodings on the same data,
+and `pages`, which times the HTML pages in-process.
+
+`update` drives a running server over HTTP instead, e.g. once with the
+default INGEST_MODE and once with INGEST_MODE=queue:
+
+    gunicorn app:app --worker-class gevent --workers 2 &
+    DASHBOARD_API_KEY=... python bench.py update --url http://127.0.0.1:8000
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+from flask import render_template_string
+
+import app as dashboard
+
+SIZES = ["<30mm", "30-50mm", "50-80mm", "80-150mm", ">150mm"]
+
+
+def report(label, seconds, rows):
+    print(f"{label:<28} {rows:>8} rows  {seconds:8.3f}s  {rows / seconds:10.0f} rows/s")
+
+
+def sample_post(i, node="bench-node"):
+    timestamp = datetime.now(timezone.utc)
+    return [(node, "ok", timestamp, size, i % 7 + n) for n, size in enumerate(SIZES)]
+
+
+# realdata is a view over readings now, so the row-per-size table and the
+# tables the older write paths updated are recreated as scratch tables; the
+# real ones only see the current path.
+SCRATCH_TABLES = ("meta", "node_totals", "realdata_minute", "realdata_daily")
+LEGACY_TABLE = """
+    CREATE TABLE IF NOT EXISTS bench_realdata (
+        id SERIAL PRIMARY KEY,
+        node TEXT,
+        status TEXT,
+        timestamp TIMESTAMPTZ,
+        size_range TEXT,
+        count INTEGER
+    )
+"""
+
+
+# The baseline write path: one INSERT per size bucket, then the meta upsert,
+# then COMMIT.
+def baseline_ingest(conn, rows):
+    with conn.cursor() as cur:
+        for row in rows:
+            cur.execute(
+                "INSERT INTO bench_realdata (node, status, timestamp, size_range, count) VALUES (%s, %s, %s, %s, %s)",
+                row
+            )
+        cur.execute("INSERT INTO bench_meta (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+                    ("last_update", max(row[2] for row in rows).isoformat()))
+    conn.commit()
+
+
+# The write path readings replaced: the rows of a post as one statement that
+# also adds them to node_totals and the minute/daily rollups and moves the
+# last_update marker, i.e. the same work ingest_rows() does, on the
+# row-per-size layout.
+def row_per_size_ingest(conn, rows):
+    totals = defaultdict(int)
+    minutes = defaultdict(int)
+    days = defaultdict(int)
+    for node, _, timestamp, size_range, count in rows:
+        totals[(node, size_range)] += count
+        minutes[(timestamp.replace(second=0, microsecond=0), node, size_range)] += count
+        days[(timestamp.astimezone(dashboard.EGYPT_TZ).date(), node, size_range)] += count
+    with conn.cursor() as cur:
+        # upsert_sums() filters on the reset guard; nothing is guarded here.
+        ctes = [
+            b"guard AS (SELECT true AS ok)",
+            b"inserted AS (INSERT INTO bench_realdata (node, status, timestamp, size_range, count) VALUES "
+            + dashboard.sql_values(cur, rows) + b")",
+            dashboard.upsert_sums(cur, b"totals", b"bench_node_totals", b"node, size_range", totals,
+                                  b", changed_xid = pg_current_xact_id()"),
+            dashboard.upsert_sums(cur, b"minutes", b"bench_realdata_minute", b"minute, node, size_range", minutes),
+            dashboard.upsert_sums(cur, b"days", b"bench_realdata_daily", b"day, node, size_range", days),
+        ]
+        cur.execute(b"WITH " + b",".join(ctes) + b"""
+            INSERT INTO bench_meta (key, value) VALUES ('last_update', %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+            WHERE bench_meta.value::timestamptz < EXCLUDED.value::timestamptz
+        """, (max(row[2] for row in rows).isoformat(),))
+    conn.commit()
+
+
+def bench_ingest(args):
+    dashboard.get_pool()  # ensures the schema
+    with dashboard.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(LEGACY_TABLE)
+            for table in SCRATCH_TABLES:
+                cur.execute(f"CREATE TABLE IF NOT EXISTS bench_{table} (LIKE {table} INCLUDING ALL)")
+    try:
+        for label, fn, autocommit in (
+            ("per-row INSERT (baseline)", baseline_ingest, False),
+            ("row per size + rollups", row_per_size_ingest, True),
+            ("readings + rollups (after)", dashboard.ingest_rows, True),
+        ):
+            rows_written = 0
+            start = time.perf_counter()
+            for i in range(args.posts):
+                rows = sample_post(i)
+                with dashboard.get_db_conn(autocommit=autocommit) as conn:
+                    fn(conn, rows)
+                rows_written += len(rows)
+            report(label, time.perf_counter() - start, rows_written)
+    finally:
+        with dashboard.get_db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DROP TABLE " + ", ".join(f"bench_{table}" for table in ("realdata",) + SCRATCH_TABLES))
+
+
+# /api/daily-trend's shaping as it was before trend_percentages(): bins keyed
+# by ISO string, and the minute total re-summed for every category.
+def legacy_trend(rows, categories):
+    minute_bins = {}
+    for minute, size_range, total in rows:
+        key = minute.astimezone(timezone.utc).isoformat()
+        if key not in minute_bins:
+            minute_bins[key] = defaultdict(int)
+        minute_bins[key][size_range] += total
+    sorted_times = sorted(minute_bins.keys())
+    datasets = []
+    for cat in categories:
+        values = []
+        for t in sorted_times:
+            total_count = sum(minute_bins[t].values())
+            percent = (minute_bins[t][cat] / total_count * 100) if total_count else 0
+            values.append(round(percent, 2))
+        datasets.append(values)
+    return sorted_times, datasets
+
+
+def synthetic_minutes(minutes):
+    rng = random.Random(42)
+    start = datetime(2025, 6, 1, tzinfo=timezone.utc)
+    return [(start + timedelta(minutes=m), size, rng.randint(0, 40))
+            for m in range(minutes) for size in SIZES]
+
+
+def best_of(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_trend(args):
+    for label, minutes in (("24h", 24 * 60), ("7d", 7 * 24 * 60)):
+        rows = synthetic_minutes(minutes)
+        legacy_times, legacy_values = legacy_trend(rows, SIZES)
+        times, values = dashboard.trend_percentages(rows, SIZES)
+        assert legacy_values == values and legacy_times == [t.isoformat() for t in times]
+        xs = [t.timestamp() for t in times]
+
+        def downsampled():
+            times, values = dashboard.trend_percentages(rows, SIZES)
+            dashboard.lttb_indices([t.timestamp() for t in times], values, args.points)
+
+        print(f"{label}: {minutes} minutes x {len(SIZES)} sizes")
+        for name, fn in (
+            ("defaultdict loops (before)", lambda: legacy_trend(rows, SIZES)),
+            ("trend_percentages (after)", lambda: dashboard.trend_percentages(rows, SIZES)),
+            (f"lttb to {args.points} points", lambda: dashboard.lttb_indices(xs, values, args.points)),
+            ("after + lttb", downsampled),
+        ):
+            print(f"  {name:<28} {best_of(fn) * 1000:8.2f} ms")
+
+
+def bench_payload(args):
+    rows = synthetic_minutes(24 * 60)
+    end_time = rows[-1][0]
+    encodings = ["gzip", "br"] if dashboard.brotli is not None else ["gzip"]
+    full = dashboard.trend_percentages(rows, SIZES)
+    kept = dashboard.lttb_indices([t.timestamp() for t in full[0]], full[1], args.points)
+    thinned = ([full[0][i] for i in kept], [[values[i] for i in kept] for values in full[1]])
+    for label, (times, percents) in (("24h, 1m buckets", full), (f"24h, lttb to {args.points}", thinned)):
+        print(f"{label}: {len(times)} points")
+        for fmt in ("json", "compact"):
+            def serialize():
+                payload = dashboard.trend_payload(times, percents, "1m", end_time, compact=fmt == "compact")
+                return dashboard.app.json.dumps(payload).encode()
+            body = serialize()
+            sizes = "  ".join(f"{encoding} {len(dashboard.compress_body(body, encoding)):>6} B" for encoding in encodings)
+            times_ms = "  ".join(f"{encoding} {best_of(lambda: dashboard.compress_body(body, encoding)) * 1000:6.2f} ms"
+                                 for encoding in encodings)
+            print(f"  {fmt:<8} {len(body):>7} B  {sizes}  | serialize {best_of(serialize) * 1000:6.2f} ms  {times_ms}")
+
+
+# The chart pages as they were served before the page shells: the template
+# recompiled by render_template_string on every request.
+def bench_pages(args):
+    client = dashboard.app.test_client()
+    with client.session_transaction() as sess:
+        sess["logged_in"] = True
+    for name, source, context in (
+        ("dashboard", dashboard.DASHBOARD_PAGE, {"size_bins": dashboard.SIZE_BINS}),
+        ("dailytrend", dashboard.DAILYTREND_PAGE, {}),
+        ("history", dashboard.HISTORY_PAGE, {}),
+    ):
+        path = f"/{name}"
+        shell = client.get(path).headers["Location"]
+
+        def legacy():
+            with dashboard.app.test_request_context(path):
+                render_template_string(source, **context)
+
+        print(name)
+        for label, fn in (
+            ("render_template_string (before)", legacy),
+            ("GET shell (after)", lambda: client.get(shell)),
+            ("GET page, shell cached (after)", lambda: client.get(path)),
+        ):
+            print(f"  {label:<32} {best_of(fn, repeat=200) * 1000:8.3f} ms")
+
+
+def percentile(sorted_values, pct):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def bench_update(args):
+    url = urlparse(args.url)
+    headers = {
+        "Authorization": f"Bearer {os.getenv('DASHBOARD_API_KEY')}",
+        "Content-Type": "application/json",
+    }
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    per_client = args.posts // args.concurrency
+
+    def client(n):
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80)
+        for i in range(per_client):
+            body = json.dumps({
+                "node": f"bench-{n}",
+                "status": "ok",
+                "rock_stats": {size: i % 7 + k for k, size in enumerate(SIZES)},
+            })
+            start = time.perf_counter()
+            conn.request("POST", "/update", body, headers)
+            response = conn.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(args.concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{len(latencies)} posts from {args.concurrency} clients in {total:.2f}s "
+          f"-> {len(latencies) / total:.0f} posts/s")
+    print(f"latency p50 {percentile(latencies, 50) * 1000:.1f}ms  "
+          f"p99 {percentile(latencies, 99) * 1000:.1f}ms  "
+          f"max {latencies[-1] * 1000:.1f}ms")
+    print("status codes:", statuses)
+
+
+BENCHMARKS = {
+    "ingest": bench_ingest,
+    "pages": bench_pages,
+    "payload": bench_payload,
+    "trend": bench_trend,
+    "update": bench_update,
+}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    ap.add_argument("--posts", type=int, default=2000, help="Pi posts to simulate")
+    ap.add_argument("--url", default="http://127.0.0.1:8000", help="server for the HTTP benchmarks")
+    ap.add_argument("--concurrency", type=int, default=20, help="concurrent HTTP clients")
+    ap.add_argument("--points", type=int, default=480, help="downsampling target for the trend benchmark")
+    args = ap.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
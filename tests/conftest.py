@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# app reads its configuration at import time.
+os.environ.setdefault("DASHBOARD_API_KEY", "test-key")
+os.environ.setdefault("FLASK_SECRET_KEY", "test-secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as dashboard  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return dashboard.app.test_client()
+
+
+@pytest.fixture
+def auth():
+    return {"Authorization": f"Bearer {dashboard.API_KEY}"}
@@ -0,0 +1,28 @@
+import threading
+
+import app as dashboard
+
+
+def fake_batches(source, start, end, node, batch_rows=None):
+    yield [("pi-1", "ok", "2025-06-01T00:00:00+00:00", "<30mm", 3)]
+
+
+def test_export_answers_503_when_all_slots_are_taken(client, auth, monkeypatch):
+    monkeypatch.setattr(dashboard, "_export_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(dashboard, "export_batches", fake_batches)
+    first = client.get("/export", headers=auth)
+    busy = client.get("/export", headers=auth)
+    assert busy.status_code == 503
+    assert busy.headers["Retry-After"] == "30"
+    first.close()
+    again = client.get("/export", headers=auth)
+    assert again.status_code == 200
+    assert again.get_data() == b'node,status,timestamp,size_range,count\r\npi-1,ok,2025-06-01T00:00:00+00:00,<30mm,3\r\n'
+    again.close()
+
+
+def test_export_releases_its_slot_after_an_invalid_request(client, auth, monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(dashboard, "_export_slots", slots)
+    assert client.get("/export?source=nope", headers=auth).status_code == 400
+    assert slots.acquire(blocking=False)
@@ -0,0 +1,41 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import app as dashboard
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.params = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.params = params
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_history_ignores_days_after_today(monkeypatch):
+    today = datetime.now(tz=dashboard.EGYPT_TZ).date()
+    # A batch timestamp a few minutes ahead can land on tomorrow in Cairo.
+    cursor = FakeCursor([(today, "small", 40.0), (today + timedelta(days=1), "small", 100.0),
+                         (today - timedelta(days=7), "small", 100.0)])
+
+    @contextmanager
+    def get_db_conn(*args, **kwargs):
+        yield type("Conn", (), {"cursor": lambda self: cursor})()
+
+    monkeypatch.setattr(dashboard, "get_db_conn", get_db_conn)
+    monkeypatch.setattr(dashboard, "data_reset_at", lambda: None)
+    monkeypatch.setattr(dashboard, "data_last_update", lambda: None)
+    with dashboard.app.test_request_context("/api/history"):
+        data = dashboard.api_history.__wrapped__().get_json()
+    assert cursor.params == (today - timedelta(days=6), today)
+    assert data["small"] == [0, 0, 0, 0, 0, 0, 40.0]
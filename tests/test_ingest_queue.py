@@ -0,0 +1,47 @@
+import time
+
+import app as dashboard
+
+
+class RecordingQueue(dashboard.IngestQueue):
+    """IngestQueue that records batches instead of writing them."""
+
+    def __init__(self, *args, fail_on=None, **kwargs):
+        self.written = []
+        self.fail_on = fail_on
+        super().__init__(*args, **kwargs)
+
+    def _write(self, posts):
+        if any(rows == self.fail_on for rows, _, _ in posts):
+            raise TypeError("unhashable type: 'list'")
+        self.written.append([rows for rows, _, _ in posts])
+
+
+def wait_for(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_flushes_after_interval_below_row_threshold():
+    q = RecordingQueue(100, 1000, 0.1)
+    for i in range(3):
+        assert q.put([("n", "ok", None, "<30mm", i)], None)
+    assert wait_for(lambda: q.stats()["pending_posts"] == 0)
+    assert sum(len(batch) for batch in q.written) == 3
+    q.drain(1)
+
+
+def test_unwritable_post_is_dropped_and_flusher_survives():
+    bad = [(["x"], "ok", None, "<30mm", 1)]
+    q = RecordingQueue(100, 1000, 0.05, fail_on=bad)
+    q.put([("a", "ok", None, "<30mm", 1)], None)
+    q.put(bad, None)
+    q.put([("b", "ok", None, "<30mm", 1)], None)
+    assert wait_for(lambda: q.stats()["pending_posts"] == 0)
+    assert q.stats()["dropped"] == 1
+    q.put([("c", "ok", None, "<30mm", 1)], None)
+    assert wait_for(lambda: q.stats()["pending_posts"] == 0)
+    assert [rows[0][0] for batch in q.written for rows in batch] == ["a", "b", "c"]
+    q.drain(1)
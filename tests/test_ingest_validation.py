@@ -0,0 +1,64 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import app as dashboard
+
+NOW = datetime(2025, 6, 1, tzinfo=timezone.utc)
+
+
+def reading(**overrides):
+    item = {"node": "pi-1", "status": "ok", "timestamp": "2025-06-01T00:00:00Z", "rock_stats": {"<30mm": 3}}
+    item.update(overrides)
+    return item
+
+
+@pytest.mark.parametrize("overrides, error", [
+    ({"node": None}, "node must be a non-empty string"),
+    ({"node": ["x"]}, "node must be a non-empty string"),
+    ({"node": {"name": "x"}}, "node must be a non-empty string"),
+    ({"node": ""}, "node must be a non-empty string"),
+    ({"status": {"ok": True}}, "status must be a non-empty string"),
+    ({"status": None}, "status must be a non-empty string"),
+    ({"version": 2}, "version must be a string"),
+    ({"rock_stats": {"<30mm": 2**31}}, "rock_stats counts must be integers from 0 to 2147483647"),
+    ({"rock_stats": {"<30mm": -1}}, "rock_stats counts must be integers from 0 to 2147483647"),
+])
+def test_parse_batch_reading_rejects(overrides, error):
+    with pytest.raises(ValueError, match=error):
+        dashboard.parse_batch_reading(reading(**overrides), NOW)
+
+
+def test_parse_batch_reading_accepts_largest_count():
+    rows, node, status, version, timestamp = dashboard.parse_batch_reading(
+        reading(rock_stats={"<30mm": 2**31 - 1}), NOW)
+    assert rows == [("pi-1", "ok", NOW, "<30mm", 2**31 - 1)]
+
+
+def test_parse_batch_reading_defaults_node_and_status():
+    item = reading()
+    del item["node"], item["status"]
+    _, node, status, _, _ = dashboard.parse_batch_reading(item, NOW)
+    assert (node, status) == ("unknown-node", "unknown")
+
+
+@pytest.mark.parametrize("body", [
+    {"node": None, "rock_stats": {"<30mm": 1}},
+    {"node": ["x"], "rock_stats": {"<30mm": 1}},
+    {"node": "pi-1", "status": {"a": 1}, "rock_stats": {"<30mm": 1}},
+    {"node": "pi-1", "rock_stats": {"<30mm": 2**31}},
+    ["not", "an", "object"],
+])
+def test_update_rejects_invalid_post(client, auth, body):
+    response = client.post("/update", json=body, headers=auth)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_update_batch_rejects_invalid_items_individually(client, auth):
+    items = [reading(node=None), reading(node="pi-2", status=["x"]), reading(rock_stats={"<30mm": 2**40})]
+    response = client.post("/update/batch", json=items, headers=auth)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["accepted"] == 0
+    assert [r["index"] for r in body["rejected"]] == [0, 1, 2]
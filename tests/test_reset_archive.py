@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import app as dashboard
+
+RESET_AT = datetime(2025, 6, 1, 12, tzinfo=timezone.utc)
+BEFORE = RESET_AT - timedelta(hours=3)
+AFTER = RESET_AT + timedelta(minutes=5)
+
+
+class FakeConn:
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def size_bin_ids(monkeypatch):
+    # Filled from size_bins by init_db() in the app.
+    monkeypatch.setattr(dashboard, "SIZE_BIN_IDS", {label: i for i, label in enumerate(dashboard.SIZE_LABELS, 1)})
+
+
+def test_tally_rows_stores_but_does_not_count_pre_reset_rows():
+    rows = [("pi-1", "ok", BEFORE, "<30mm", 3), ("pi-1", "ok", AFTER, "<30mm", 4)]
+    readings, totals, minutes, days, seen, first_counted, last_archived = dashboard.tally_rows(rows, RESET_AT)
+    assert set(readings) == {("pi-1", "ok", BEFORE), ("pi-1", "ok", AFTER)}
+    assert dict(totals) == {("pi-1", "<30mm"): 4}
+    assert seen == {"pi-1": AFTER}
+    assert (first_counted, last_archived) == (AFTER, BEFORE)
+
+
+def test_pre_reset_batch_leaves_last_update_unchanged(monkeypatch):
+    # Right after a reset: no reading counted yet.
+    state = (7, None, RESET_AT)
+    published = []
+    monkeypatch.setattr(dashboard, "get_broadcaster", lambda: SimpleNamespace(state=state))
+    monkeypatch.setattr(dashboard, "publish_data_change", lambda conn, **event: published.append(event))
+
+    def write_rows(conn, rows, reset_at):
+        seen = dashboard.tally_rows(rows, reset_at)[4]
+        return True, reset_at, max(seen.values(), default=None)
+    monkeypatch.setattr(dashboard, "write_rows", write_rows)
+
+    dashboard.ingest_rows(FakeConn(), [("pi-1", "ok", BEFORE, "<30mm", 3)])
+    assert published == [{}]
+    assert dashboard.UpdateBroadcaster._apply(state, {**published[0], "version": 8}) == (8, None, RESET_AT)
+
+    dashboard.ingest_rows(FakeConn(), [("pi-1", "ok", BEFORE, "<30mm", 3), ("pi-1", "ok", AFTER, "<30mm", 4)])
+    assert published[1] == {"last_update": AFTER.isoformat()}
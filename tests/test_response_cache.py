@@ -0,0 +1,33 @@
+import app as dashboard
+
+
+def test_sqlite_cache_hits_do_not_write(tmp_path, monkeypatch):
+    cache = dashboard.SqliteResponseCache(str(tmp_path / "cache.sqlite3"), max_entries=4, ttl=300)
+    clock = [1000.0]
+    monkeypatch.setattr(dashboard.time, "time", lambda: clock[0])
+    cache._store("a", (200, "application/json", b"{}"))
+    writes = cache._db.total_changes
+    for _ in range(100):
+        clock[0] += 0.1
+        assert cache._load("a") == (200, "application/json", b"{}")
+    assert cache._db.total_changes == writes
+
+    # Past a tenth of the TTL the hit is recorded once more for eviction.
+    clock[0] += 30
+    cache._load("a")
+    cache._load("a")
+    assert cache._db.total_changes == writes + 1
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    cache = dashboard.SqliteResponseCache(str(tmp_path / "cache.sqlite3"), max_entries=2, ttl=300)
+    clock = [1000.0]
+    monkeypatch.setattr(dashboard.time, "time", lambda: clock[0])
+    cache._store("a", (200, "application/json", b"a"))
+    clock[0] += 1
+    cache._store("b", (200, "application/json", b"b"))
+    clock[0] += 60
+    assert cache._load("a") is not None
+    cache._store("c", (200, "application/json", b"c"))
+    assert cache._load("b") is None
+    assert cache._load("a") is not None
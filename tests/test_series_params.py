@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import app as dashboard
+
+CAIRO = pytz.timezone("Africa/Cairo")
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("30s", timedelta(seconds=30)),
+    ("5m", timedelta(minutes=5)),
+    ("1w", timedelta(weeks=1)),
+    ("36525d", timedelta(days=36525)),
+])
+def test_parse_series_bucket(value, expected):
+    assert dashboard.parse_series_bucket(value) == expected
+
+
+@pytest.mark.parametrize("value", ["0h", "1y", "-1d", "1.5h", ""])
+def test_parse_series_bucket_rejects_malformed(value):
+    with pytest.raises(ValueError, match="bucket must look like"):
+        dashboard.parse_series_bucket(value)
+
+
+@pytest.mark.parametrize("value", ["36526d", "999999999d", "1000000000d", "99999999999999999999d", "9" * 400 + "w"])
+def test_parse_series_bucket_rejects_too_large(value):
+    with pytest.raises(ValueError, match="bucket must be at most 36525d"):
+        dashboard.parse_series_bucket(value)
+
+
+def test_parse_series_time_localizes_naive():
+    assert dashboard.parse_series_time("2025-06-01T12:00:00", CAIRO, "from") == CAIRO.localize(datetime(2025, 6, 1, 12))
+
+
+@pytest.mark.parametrize("value", ["0001-01-01T00:00:00", "0001-01-01T00:00:00Z", "9999-12-31T23:00:00",
+                                   "9999-12-31T23:59:59-05:00"])
+def test_parse_series_time_rejects_out_of_range(value):
+    with pytest.raises(ValueError, match="^to must be between the years 2 and 9998$"):
+        dashboard.parse_series_time(value, CAIRO, "to")
+
+
+@pytest.mark.parametrize("value", ["nota", "2025-13-01", "2025-06-01T25:00", "1700000000x", ""])
+def test_parse_series_time_rejects_malformed_with_fixed_message(value):
+    with pytest.raises(ValueError, match="^from must be an ISO-8601 time$"):
+        dashboard.parse_series_time(value, CAIRO, "from")
+